@@ -0,0 +1,244 @@
+"""
+End-to-end benchmark of the ETL against local stand-ins of glue-api, Mapbox,
+Overpass and Brasil Aberto, loading into a local Postgres. Reports listings per
+second, requests per listing, peak memory and the slowest stages of the run.
+
+    python -m benchmarks.etl_benchmark --neighborhoods 4 --listings 500 --latency-ms 50
+
+The database is set with DB_HOST, DB_PORT, DB_NAME, DB_USER and DB_PASS, by default
+a local buskasa_benchmark database. Its listing and analysis tables are emptied
+before every run.
+"""
+import argparse
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+from benchmarks.stand_ins import (
+    ProviderStandIn,
+    StandInBehavior,
+    create_brasil_aberto_handler,
+    create_glue_api_handler,
+    create_mapbox_handler,
+    create_overpass_handler,
+)
+from benchmarks.synthetic import SyntheticMarket
+
+# Configure logging
+logging.basicConfig(
+    format="%(asctime)s %(name)-12s %(levelname)-8s %(message)s", level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+REPOSITORY_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCHEMA_PATH = os.path.join(REPOSITORY_PATH, "benchmarks", "schema.sql")
+LOCAL_HOSTS = ("localhost", "127.0.0.1", "::1")
+# Tables emptied before every run, so runs are comparable
+RESET_TABLES = [
+    "fact_listings",
+    "dim_zip_code",
+    "fact_image_analysis",
+    "fact_traffic_analysis",
+    "etl_neighborhood_history",
+    "etl_run_checkpoints",
+    "etl_run_pages",
+    "etl_neighborhood_watermarks",
+]
+
+
+def prepare_database(db_manager):
+    """Create the base tables if needed and empty the tables written by the ETL"""
+    from sqlalchemy import text
+
+    with open(SCHEMA_PATH) as file:
+        schema = file.read()
+    with db_manager.get_transaction() as conn:
+        conn.exec_driver_sql(schema)
+        for table in RESET_TABLES:
+            if conn.execute(text("SELECT to_regclass(:table)"), {"table": table}).scalar():
+                conn.execute(text(f"TRUNCATE {table}"))
+
+
+def count_loaded_listings(db_manager) -> int:
+    from sqlalchemy import text
+
+    with db_manager.get_connection() as conn:
+        return conn.execute(text("SELECT count(*) FROM fact_listings")).scalar()
+
+
+def get_children_peak_memory_mb() -> float:
+    """Get the peak resident memory of the finished child processes"""
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # Reported in bytes on macOS and kilobytes on Linux
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+
+def run_benchmark(
+    neighborhoods: int = 4,
+    listings_per_neighborhood: int = 500,
+    business_type: str = "SALE",
+    behaviors: dict = None,
+    proxy_lanes: int = 4,
+    seed: int = 0,
+    extra_env: dict = None,
+) -> dict:
+    """
+    Run etl.py end to end on a manifest of synthetic neighborhoods
+    Args:
+        neighborhoods (int): Neighborhoods of the market
+        listings_per_neighborhood (int): Listings of each neighborhood
+        business_type (str): SALE or RENTAL
+        behaviors (dict): StandInBehavior by provider name, default for the missing ones
+        proxy_lanes (int): Proxies of the pool, all pointing to the glue-api stand-in
+        seed (int): Seed of the listings, latencies and errors
+        extra_env (dict): Environment variables of the ETL, e.g. to enable a feature
+    Returns:
+        Report of the run
+    """
+    behaviors = behaviors or {}
+    market = SyntheticMarket(listings_per_neighborhood=listings_per_neighborhood, seed=seed)
+    stand_ins = {
+        "glue_api": ProviderStandIn(
+            "glue_api", create_glue_api_handler(market), behaviors.get("glue_api", StandInBehavior()), seed
+        ),
+        "mapbox": ProviderStandIn(
+            "mapbox", create_mapbox_handler(), behaviors.get("mapbox", StandInBehavior()), seed
+        ),
+        "overpass": ProviderStandIn(
+            "overpass", create_overpass_handler(seed), behaviors.get("overpass", StandInBehavior()), seed
+        ),
+        "brasil_aberto": ProviderStandIn(
+            "brasil_aberto", create_brasil_aberto_handler(), behaviors.get("brasil_aberto", StandInBehavior()), seed
+        ),
+    }
+    for stand_in in stand_ins.values():
+        stand_in.start()
+
+    glue_api_url = stand_ins["glue_api"].url
+    with tempfile.TemporaryDirectory(prefix="etl-benchmark-") as directory:
+        manifest_path = os.path.join(directory, "markets.json")
+        trace_report_path = os.path.join(directory, "trace_report.json")
+        with open(manifest_path, "w") as file:
+            json.dump(
+                {
+                    "max_concurrent_markets": 1,
+                    "markets": [
+                        {
+                            "state": market.state,
+                            "city": market.city,
+                            "unit_type": "APARTMENT",
+                            "business_type": business_type,
+                            "neighborhoods": [f"Bairro {number + 1}" for number in range(neighborhoods)],
+                        }
+                    ],
+                },
+                file,
+            )
+        env = {
+            **os.environ,
+            "GLUE_API_URL": glue_api_url,
+            "MAPBOX_API_URL": stand_ins["mapbox"].url,
+            "OVERPASS_API_URL": stand_ins["overpass"].url,
+            "BRASIL_ABERTO_API_URL": stand_ins["brasil_aberto"].url,
+            # The stand-in also answers as a proxy, each lane with its own credentials
+            "GLUE_API_PROXIES": ",".join(
+                glue_api_url.replace("http://", f"http://lane{lane}:benchmark@")
+                for lane in range(proxy_lanes)
+            ),
+            "MAPBOX_TOKEN": "benchmark",
+            "BRASIL_ABERTO_API_KEY_PAID": "benchmark",
+            "BRASIL_ABERTO_API_KEY_FREE": "benchmark",
+            "REFERENCE_SNAPSHOT_PATH": os.path.join(directory, "reference_snapshot.sqlite"),
+            "ETL_RUN_ID": f"benchmark-{uuid.uuid4().hex[:8]}",
+            "ETL_TRACE_REPORT_PATH": trace_report_path,
+            **(extra_env or {}),
+        }
+        # Imported once the database is configured, as the manager reads it on import
+        from src.database import db_manager
+
+        prepare_database(db_manager)
+        logger.info(
+            f"Running the ETL on {neighborhoods} neighborhoods of {listings_per_neighborhood} listings"
+        )
+        start = time.perf_counter()
+        try:
+            subprocess.run(
+                [sys.executable, "etl.py", "--manifest", manifest_path],
+                cwd=REPOSITORY_PATH,
+                env=env,
+                check=True,
+            )
+        finally:
+            seconds = time.perf_counter() - start
+            for stand_in in stand_ins.values():
+                stand_in.stop()
+        with open(trace_report_path) as file:
+            trace_report = json.load(file)
+
+    parsed_listings = trace_report["stages"].get("item_parse", {}).get("rows", 0)
+    requests = {name: stand_in.get_metrics() for name, stand_in in stand_ins.items()}
+    total_requests = sum(metrics["requests"] for metrics in requests.values())
+    return {
+        "neighborhoods": neighborhoods,
+        "listings_per_neighborhood": listings_per_neighborhood,
+        "seconds": round(seconds, 2),
+        "parsed_listings": parsed_listings,
+        "loaded_listings": count_loaded_listings(db_manager),
+        "listings_per_second": round(parsed_listings / seconds, 2),
+        "requests_per_listing": round(total_requests / max(parsed_listings, 1), 3),
+        "requests": {name: metrics["requests"] for name, metrics in requests.items()},
+        "injected_errors": {name: metrics["errors"] for name, metrics in requests.items()},
+        "peak_memory_mb": round(get_children_peak_memory_mb(), 1),
+        "slowest_stages": dict(list(trace_report["stages"].items())[:10]),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--neighborhoods", type=int, default=4)
+    parser.add_argument("--listings", type=int, default=500, help="Listings per neighborhood")
+    parser.add_argument("--business-type", choices=["SALE", "RENTAL"], default="SALE")
+    parser.add_argument("--latency-ms", type=float, default=50.0, help="Latency of every provider")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests failing with a 503")
+    parser.add_argument("--proxy-lanes", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Path to write the report to, as JSON")
+    parser.add_argument(
+        "--allow-remote-database",
+        action="store_true",
+        help="Allow a database that isn't local, whose tables will be emptied",
+    )
+    args = parser.parse_args()
+
+    os.environ.setdefault("DB_HOST", "127.0.0.1")
+    os.environ.setdefault("DB_PORT", "5432")
+    os.environ.setdefault("DB_NAME", "buskasa_benchmark")
+    if os.environ["DB_HOST"] not in LOCAL_HOSTS and not args.allow_remote_database:
+        parser.error(
+            f"DB_HOST {os.environ['DB_HOST']} isn't local and its tables would be emptied, "
+            "use --allow-remote-database if that is intended"
+        )
+
+    behavior = StandInBehavior(latency_ms=args.latency_ms, error_rate=args.error_rate)
+    report = run_benchmark(
+        neighborhoods=args.neighborhoods,
+        listings_per_neighborhood=args.listings,
+        business_type=args.business_type,
+        behaviors={name: behavior for name in ["glue_api", "mapbox", "overpass", "brasil_aberto"]},
+        proxy_lanes=args.proxy_lanes,
+        seed=args.seed,
+    )
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
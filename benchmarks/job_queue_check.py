@@ -0,0 +1,159 @@
+"""
+Checks of the job queue against a local Postgres: claims skipping jobs leased by
+other workers, heartbeats, retries of failed jobs, lease expiry and jobs failed
+once their last attempt expires.
+
+    python -m benchmarks.job_queue_check
+
+The database is set with DB_HOST, DB_PORT, DB_NAME, DB_USER and DB_PASS, by default
+a local buskasa_benchmark database. Its base tables and migrations are applied,
+and the jobs added by the check are deleted by its end.
+"""
+import argparse
+import logging
+import os
+import time
+import uuid
+
+# Configure logging
+logging.basicConfig(
+    format="%(asctime)s %(name)-12s %(levelname)-8s %(message)s", level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "schema.sql")
+LOCAL_HOSTS = ("localhost", "127.0.0.1", "::1")
+
+
+def check(condition: bool, message: str):
+    if not condition:
+        raise AssertionError(message)
+    logger.info(f"OK: {message}")
+
+
+def get_job_status(db_manager, job_id: int) -> dict:
+    from sqlalchemy import text
+
+    with db_manager.get_connection() as conn:
+        return dict(
+            conn.execute(
+                text("SELECT status, attempts, lease_owner FROM etl_jobs WHERE id = :job_id"),
+                {"job_id": job_id},
+            ).mappings().first()
+        )
+
+
+def run_checks(db_manager, lease_seconds: float = 1):
+    """
+    Run the checks on jobs of a new run, deleting them by the end
+    Args:
+        db_manager: Database manager of a local database
+        lease_seconds (float): Lease of the jobs, waited for to check expiry
+    """
+    from sqlalchemy import text
+
+    from src.job_queue import JobQueue
+
+    queue = JobQueue(db_manager, lease_seconds=lease_seconds)
+    run_id = f"job-queue-check-{uuid.uuid4().hex[:8]}"
+    jobs = [
+        {
+            "state": "SP",
+            "city": "São Paulo",
+            "neighborhood": neighborhood,
+            "unit_type": "APARTMENT",
+            "business_type": "SALE",
+            "min_price": 200000,
+            "max_price": 2000000,
+        }
+        for neighborhood in ["Bairro 1", "Bairro 2"]
+    ]
+    try:
+        check(queue.enqueue(run_id, jobs, max_attempts=2) == 2, "jobs are enqueued")
+        check(queue.enqueue(run_id, jobs, max_attempts=2) == 0, "jobs already on the run are ignored")
+
+        first = queue.claim("worker-a", run_id)
+        second = queue.claim("worker-b", run_id)
+        check(
+            first is not None and second is not None and first["id"] != second["id"],
+            "workers claim different jobs",
+        )
+        check(queue.claim("worker-c", run_id) is None, "leased jobs aren't claimed again")
+        check(queue.heartbeat(first["id"], "worker-a"), "the lease owner extends its lease")
+        check(not queue.heartbeat(first["id"], "worker-b"), "other workers can't extend the lease")
+
+        queue.fail(first["id"], "worker-a", "RuntimeError('check')")
+        check(get_job_status(db_manager, first["id"])["status"] == "pending", "failed jobs are released")
+        retried = queue.claim("worker-a", run_id)
+        check(
+            retried is not None and retried["id"] == first["id"] and retried["attempts"] == 2,
+            "failed jobs are retried",
+        )
+
+        # Both workers die: the first job is on its last attempt, the second one isn't
+        time.sleep(lease_seconds + 0.5)
+        taken_over = queue.claim("worker-c", run_id)
+        check(
+            taken_over is not None and taken_over["id"] == second["id"] and taken_over["attempts"] == 2,
+            "jobs whose lease expired are claimed by another worker",
+        )
+        check(
+            get_job_status(db_manager, first["id"])["status"] == "failed",
+            "jobs whose last attempt expired are failed",
+        )
+        check(
+            not queue.complete(second["id"], "worker-b", {"n_listings": 0}),
+            "workers that lost the lease can't complete the job",
+        )
+        check(
+            not queue.is_market_done(run_id, "São Paulo", "SALE", "APARTMENT"),
+            "markets with running jobs aren't done",
+        )
+        check(queue.complete(second["id"], "worker-c", {"n_listings": 10}), "the lease owner completes the job")
+        check(
+            queue.is_market_done(run_id, "São Paulo", "SALE", "APARTMENT"),
+            "markets whose jobs finished are done",
+        )
+        summary = queue.get_summary(run_id)
+        check(
+            summary["done"]["jobs"] == 1 and summary["failed"]["jobs"] == 1,
+            "the summary counts jobs by status",
+        )
+    finally:
+        with db_manager.get_transaction() as conn:
+            conn.execute(text("DELETE FROM etl_jobs WHERE run_id = :run_id"), {"run_id": run_id})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lease-seconds", type=float, default=1, help="Lease of the jobs of the check")
+    parser.add_argument(
+        "--allow-remote-database",
+        action="store_true",
+        help="Allow a database that isn't local, whose migrations will be applied",
+    )
+    args = parser.parse_args()
+
+    os.environ.setdefault("DB_HOST", "127.0.0.1")
+    os.environ.setdefault("DB_PORT", "5432")
+    os.environ.setdefault("DB_NAME", "buskasa_benchmark")
+    if os.environ["DB_HOST"] not in LOCAL_HOSTS and not args.allow_remote_database:
+        parser.error(
+            f"DB_HOST {os.environ['DB_HOST']} isn't local, "
+            "use --allow-remote-database if that is intended"
+        )
+
+    # Imported once the database is configured, as the manager reads it on import
+    from src.database import db_manager
+    from src.migrations import migrate
+
+    # Migrations expect the base tables
+    with open(SCHEMA_PATH) as file, db_manager.get_transaction() as conn:
+        conn.exec_driver_sql(file.read())
+    migrate()
+    run_checks(db_manager, args.lease_seconds)
+    logger.info("All job queue checks passed")
+
+
+if __name__ == "__main__":
+    main()
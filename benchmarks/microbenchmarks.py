@@ -0,0 +1,341 @@
+"""
+Microbenchmarks of the hot functions of the ETL and the app, on fixed synthetic
+fixtures, compared against the baselines on benchmarks/baselines.json. Exits with
+an error when a benchmark is slower than its baseline by more than its allowed
+regression.
+
+    python -m benchmarks.microbenchmarks
+    python -m benchmarks.microbenchmarks --only transform.convert_to_dataframe
+    python -m benchmarks.microbenchmarks --save-baselines
+
+No network access or credentials are needed: enrichment is served from analysis
+tiles and zip codes prepared in memory.
+"""
+import argparse
+import io
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+
+# Modules read these on import, but nothing connects with them
+for variable in ["DB_USER", "DB_PASS", "MAPBOX_TOKEN"]:
+    os.environ.setdefault(variable, "benchmark")
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+from benchmarks.stand_ins import create_satellite_image
+from benchmarks.synthetic import SyntheticMarket
+
+# Configure logging
+logging.basicConfig(
+    format="%(asctime)s %(name)-12s %(levelname)-8s %(message)s", level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+BASELINES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines.json")
+# Allowed slowdown over the baseline, when a benchmark doesn't set its own
+DEFAULT_MAX_REGRESSION = 0.5
+SEED = 0
+
+# Benchmarks by name, as (setup, rounds). The setup builds the fixtures and
+# returns the function timed on each round
+BENCHMARKS = {}
+
+
+def benchmark(name: str, rounds: int = 20):
+    """Register a benchmark setup under a name"""
+
+    def decorator(setup):
+        BENCHMARKS[name] = (setup, rounds)
+        return setup
+
+    return decorator
+
+
+def create_neighborhood(listings: list):
+    """
+    Create a neighborhood whose zip codes and analysis tiles cover the listings,
+    with an expired time budget, so items are built without any request
+    """
+    from src.classes import ZapNeighborhood
+    from src.resilience import Deadline
+
+    neighborhood = ZapNeighborhood(
+        state="SP",
+        city="São Paulo",
+        neighborhood="Bairro 1",
+        unit_type="APARTMENT",
+        unit_type_v3="APARTMENT",
+        unit_subtype="UnitSubType_NONE,DUPLEX,TRIPLEX",
+        business_type="SALE",
+        max_price=10**10,
+        min_price=0,
+        min_area=0,
+        session_number=0,
+        deadline=Deadline(0),
+    )
+    zip_codes = sorted({listing["listing"]["address"]["zipCode"] for listing in listings})
+    neighborhood.existing_zip_codes = pd.DataFrame(
+        {"complement": [f"de {number} a {number + 200} - lado ímpar" for number in range(1, 2 * len(zip_codes), 2)]},
+        index=zip_codes,
+    )
+    generator = np.random.default_rng(SEED)
+    # Satellite tiles of 0.01 degrees across the city
+    lats, lons = np.meshgrid(np.arange(-23.75, -23.35, 0.01), np.arange(-46.83, -46.43, 0.01))
+    neighborhood.existing_image_analysis = pd.DataFrame(
+        {
+            "min_lat": lats.ravel().round(3),
+            "max_lat": (lats.ravel() + 0.01).round(3),
+            "min_lon": lons.ravel().round(3),
+            "max_lon": (lons.ravel() + 0.01).round(3),
+            "green_density": generator.random(lats.size),
+            "is_next_to_park": generator.random(lats.size) < 0.3,
+        }
+    )
+    # Traffic tiles of 0.001 degrees across the neighborhood
+    points = pd.DataFrame([listing["listing"]["address"]["point"] for listing in listings])
+    lats, lons = np.meshgrid(
+        np.arange(points["lat"].min() - 0.002, points["lat"].max() + 0.002, 0.001),
+        np.arange(points["lon"].min() - 0.002, points["lon"].max() + 0.002, 0.001),
+    )
+    neighborhood.existing_traffic_analysis = pd.DataFrame(
+        {
+            "min_lat": lats.ravel().round(4),
+            "max_lat": (lats.ravel() + 0.001).round(4),
+            "min_lon": lons.ravel().round(4),
+            "max_lon": (lons.ravel() + 0.001).round(4),
+            "n_nearby_bus_lanes": generator.integers(0, 12, lats.size),
+        }
+    )
+    return neighborhood
+
+
+def create_page(listings_per_page: int = 100):
+    """Create a page of synthetic listings, with its items not built yet"""
+    from src.classes import ZapPage
+
+    listings = SyntheticMarket(listings_per_neighborhood=listings_per_page, seed=SEED).get_listings(
+        "Bairro 1", "SALE"
+    )
+    zap_page = ZapPage(0, create_neighborhood(listings))
+    zap_page.listings = listings
+    return zap_page
+
+
+def create_page_items():
+    """Create a page with its items built"""
+    random.seed(SEED)
+    np.random.seed(SEED)
+    zap_page = create_page()
+    zap_page.create_zap_items()
+    return zap_page.zap_items_to_add
+
+
+@benchmark("transform.calculate_green_density", rounds=3)
+def setup_calculate_green_density():
+    from src import transform
+
+    image = Image.open(io.BytesIO(create_satellite_image(seed=SEED)))
+    return lambda: transform.calculate_green_density(image)
+
+
+@benchmark("ZapPage.create_zap_items")
+def setup_create_zap_items():
+    zap_page = create_page()
+
+    def run():
+        random.seed(SEED)
+        np.random.seed(SEED)
+        zap_page.zap_items_to_add = []
+        zap_page.create_zap_items()
+
+    return run
+
+
+@benchmark("transform.convert_to_dataframe")
+def setup_convert_to_dataframe():
+    from src import transform
+
+    # Items of ten pages
+    items = create_page_items() * 10
+    return lambda: transform.convert_to_dataframe(items)
+
+
+@benchmark("ZapItem.get_sat_image_analysis_metrics")
+def setup_get_sat_image_analysis_metrics():
+    items = create_page_items()
+
+    def run():
+        for item in items:
+            item.get_sat_image_analysis_metrics()
+
+    return run
+
+
+@benchmark("ZapNeighborhood.remove_duplicated_listings")
+def setup_remove_duplicated_listings():
+    from src import transform
+
+    items = create_page_items()
+    listings = transform.convert_to_dataframe(items)
+    # 20000 listings, a fifth of them duplicated with other prices
+    listings = listings.sample(16000, replace=True, random_state=SEED)
+    listings["street_number"] = np.random.default_rng(SEED).integers(1, 3000, len(listings))
+    duplicates = listings.sample(4000, random_state=SEED).assign(price=lambda df: df["price"] * 1.1)
+    listings = pd.concat([listings, duplicates], ignore_index=True)
+    neighborhood = items[0]._zap_page.zap_search
+
+    def run():
+        neighborhood.listings_to_add = listings
+        neighborhood.remove_duplicated_listings()
+
+    return run
+
+
+@benchmark("app.get_listing_filters_mask")
+def setup_get_listing_filters_mask():
+    from src.app_classes import get_listing_filters_mask
+
+    generator = np.random.default_rng(SEED)
+    size = 50000
+    neighborhoods = [f"Bairro {number}" for number in range(1, 97)]
+    data = pd.DataFrame(
+        {
+            "neighborhood": generator.choice(neighborhoods, size),
+            "location_type": generator.choice(["Rua", "Avenida", "Alameda", "Travessa"], size),
+            "unit_type": generator.choice(["APARTMENT", "FLAT", "PENTHOUSE", "HOME", "CONDOMINIUM"], size),
+            "bedrooms": generator.integers(1, 6, size),
+            "total_area_m2": generator.integers(30, 400, size),
+            "price": generator.integers(200000, 5000000, size),
+            "price_per_area": generator.integers(4000, 25000, size),
+            "green_density_grouped": generator.choice(["Pouco Verde", "Moderadamente Verde", "Bastante Verde"], size),
+            "n_nearby_bus_lanes_grouped": generator.choice(["Muito Calmo", "Calmo", "Movimentado", "Agitado"], size),
+            "is_remodeled": generator.random(size) < 0.2,
+        }
+    )
+    filters = {
+        "neighborhood": neighborhoods[:10],
+        "location_type": ["Rua", "Alameda"],
+        "unit_type": ["Apartamentos"],
+        "number_bedrooms": 2,
+        "area": (50, 200),
+        "price": 2000000,
+        "price_per_area": 15000,
+        "green_density": ["Moderadamente Verde", "Bastante Verde"],
+        "movement_intensity": ["Muito Calmo", "Calmo"],
+        "is_remodeled": True,
+    }
+    return lambda: data.loc[get_listing_filters_mask(data, **filters)]
+
+
+def measure(function, rounds: int, warmup: int = 1) -> list:
+    """Time a function over some rounds, after warming it up"""
+    for _ in range(warmup):
+        function()
+    durations = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def load_baselines(path: str = BASELINES_PATH) -> dict:
+    if not os.path.exists(path):
+        return {"max_regression": DEFAULT_MAX_REGRESSION, "benchmarks": {}}
+    with open(path) as file:
+        return json.load(file)
+
+
+def save_baselines(results: dict, path: str = BASELINES_PATH):
+    """Store the medians of the results as baselines, keeping the allowed regressions"""
+    baselines = load_baselines(path)
+    baselines["machine"] = f"{platform.machine()} {platform.processor() or platform.system()}, Python {platform.python_version()}"
+    for name, result in results.items():
+        baseline = baselines["benchmarks"].setdefault(name, {})
+        baseline["median_seconds"] = result["median_seconds"]
+        baseline["rounds"] = result["rounds"]
+    with open(path, "w") as file:
+        json.dump(baselines, file, indent=2)
+        file.write("\n")
+    logger.info(f"Saved {len(results)} baselines to {path}")
+
+
+def run_benchmarks(names: list, rounds: int = None) -> dict:
+    """
+    Run benchmarks and summarize their durations
+    Args:
+        names (list): Names of the benchmarks to run
+        rounds (int): Rounds of every benchmark, instead of their own
+    Returns:
+        Dictionary with the median, min and max seconds of each benchmark, by name
+    """
+    results = {}
+    for name in names:
+        setup, default_rounds = BENCHMARKS[name]
+        function = setup()
+        durations = measure(function, rounds or default_rounds)
+        results[name] = {
+            "rounds": len(durations),
+            "median_seconds": round(statistics.median(durations), 6),
+            "min_seconds": round(min(durations), 6),
+            "max_seconds": round(max(durations), 6),
+        }
+    return results
+
+
+def compare_to_baselines(results: dict, baselines: dict) -> list:
+    """
+    Print the results against their baselines
+    Returns:
+        Names of the benchmarks slower than allowed
+    """
+    regressions = []
+    print(f"{'benchmark':<45} {'median':>12} {'baseline':>12} {'change':>8}")
+    for name, result in results.items():
+        baseline = baselines["benchmarks"].get(name)
+        median = result["median_seconds"]
+        if baseline is None:
+            print(f"{name:<45} {median * 1000:>10.2f}ms {'-':>12} {'-':>8}  no baseline")
+            continue
+        change = median / baseline["median_seconds"] - 1
+        max_regression = baseline.get("max_regression", baselines.get("max_regression", DEFAULT_MAX_REGRESSION))
+        status = ""
+        if change > max_regression:
+            regressions.append(name)
+            status = f"  REGRESSION, over +{max_regression:.0%}"
+        print(
+            f"{name:<45} {median * 1000:>10.2f}ms {baseline['median_seconds'] * 1000:>10.2f}ms {change:>+8.1%}{status}"
+        )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--only", nargs="+", choices=sorted(BENCHMARKS), help="Benchmarks to run")
+    parser.add_argument("--rounds", type=int, help="Rounds of every benchmark, instead of their own")
+    parser.add_argument("--save-baselines", action="store_true", help="Store the results as the new baselines")
+    parser.add_argument("--baselines", default=BASELINES_PATH, help="Path to the baselines")
+    args = parser.parse_args()
+
+    # Progress logs of the functions benchmarked would only add noise
+    logging.getLogger("src").setLevel(logging.WARNING)
+    results = run_benchmarks(args.only or list(BENCHMARKS), args.rounds)
+    if args.save_baselines:
+        save_baselines(results, args.baselines)
+        return
+    regressions = compare_to_baselines(results, load_baselines(args.baselines))
+    if regressions:
+        logger.error(f"{len(regressions)} benchmarks regressed: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
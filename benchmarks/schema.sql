@@ -0,0 +1,75 @@
+-- Base tables of the ETL on a local benchmark database. Tables and indexes
+-- added later are created by the migrations at the start of every run
+CREATE TABLE IF NOT EXISTS fact_listings (
+    listing_id text PRIMARY KEY,
+    description text,
+    listing_date date,
+    updated_at date,
+    new_listing boolean,
+    unit_type text,
+    bedrooms integer,
+    bathrooms integer,
+    vacancies integer,
+    floor integer,
+    construction_year integer,
+    total_area_m2 integer,
+    business_type text,
+    country text,
+    state text,
+    city text,
+    neighborhood text,
+    zip_code text,
+    street_address text,
+    street_number integer,
+    location_type text,
+    address text,
+    latitude double precision,
+    longitude double precision,
+    precision text,
+    green_density double precision,
+    is_next_to_park boolean,
+    n_nearby_bus_lanes integer,
+    is_quiet boolean,
+    price bigint,
+    condo_fee integer,
+    price_per_area double precision,
+    url text,
+    link text,
+    advertizer text,
+    primary_phone text,
+    recent_account boolean,
+    account_is_unlicensed boolean,
+    price_per_area_in_first_quartile boolean,
+    green_density_grouped text,
+    n_nearby_bus_lanes_grouped text
+);
+
+CREATE TABLE IF NOT EXISTS dim_zip_code (
+    zip_code text PRIMARY KEY,
+    complement text
+);
+
+CREATE TABLE IF NOT EXISTS fact_image_analysis (
+    id bigserial PRIMARY KEY,
+    min_lat double precision,
+    max_lat double precision,
+    min_lon double precision,
+    max_lon double precision,
+    green_density double precision,
+    is_next_to_park boolean
+);
+
+CREATE TABLE IF NOT EXISTS fact_traffic_analysis (
+    id bigserial PRIMARY KEY,
+    min_lat double precision,
+    max_lat double precision,
+    min_lon double precision,
+    max_lon double precision,
+    n_nearby_bus_lanes integer
+);
+
+CREATE TABLE IF NOT EXISTS city_neighborhoods (
+    state text,
+    city text,
+    neighborhood text
+);
@@ -0,0 +1,205 @@
+import io
+import json
+import logging
+import random
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+import numpy as np
+from PIL import Image
+
+# Configure logging
+logging.basicConfig(
+    format="%(asctime)s %(name)-12s %(levelname)-8s %(message)s", level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class StandInBehavior:
+    """Latency and errors of a provider stand-in"""
+
+    latency_ms: float = 50.0
+    # Latency varies uniformly by this share around latency_ms
+    jitter: float = 0.5
+    # Share of requests answered with a 503
+    error_rate: float = 0.0
+
+
+class ProviderStandIn:
+    """
+    Local HTTP server standing in for an external provider. Requests are answered
+    by a handler function after the configured latency, or with a 503 at the
+    configured error rate, and counted by path. The server also accepts requests
+    sent to it as an HTTP proxy, with absolute URLs
+    """
+
+    def __init__(self, name: str, handler, behavior: StandInBehavior, seed: int = 0):
+        """
+        Args:
+            name (str): Name of the provider
+            handler: Function of the method, path, query parameters and body
+                returning the status, content type and body of the response
+            behavior (StandInBehavior): Latency and errors of the provider
+            seed (int): Seed of the latency and errors
+        """
+        self.name = name
+        self.handler = handler
+        self.behavior = behavior
+        self.requests = Counter()
+        self.errors = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._create_request_handler())
+        self.server.daemon_threads = True
+        self._thread = threading.Thread(target=self.server.serve_forever, name=f"stand-in-{name}", daemon=True)
+
+    @property
+    def url(self) -> str:
+        """Base URL of the stand-in"""
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "ProviderStandIn":
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get_delay(self) -> tuple:
+        """Draw the latency of a request and whether it fails"""
+        with self._lock:
+            jitter = self._random.uniform(-self.behavior.jitter, self.behavior.jitter)
+            fails = self._random.random() < self.behavior.error_rate
+        return max(0.0, self.behavior.latency_ms * (1 + jitter) / 1000), fails
+
+    def _create_request_handler(self):
+        stand_in = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def handle_request(self, method):
+                url = urlsplit(self.path)
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                delay, fails = stand_in.get_delay()
+                time.sleep(delay)
+                with stand_in._lock:
+                    stand_in.requests[url.path] += 1
+                    stand_in.errors += fails
+                if fails:
+                    status, content_type, content = 503, "text/plain", b"Service unavailable"
+                else:
+                    status, content_type, content = stand_in.handler(
+                        method, url.path, dict(parse_qsl(url.query)), body
+                    )
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(content)))
+                if status == 503:
+                    self.send_header("Retry-After", "0")
+                self.end_headers()
+                self.wfile.write(content)
+
+            def do_GET(self):
+                self.handle_request("GET")
+
+            def do_POST(self):
+                self.handle_request("POST")
+
+            def log_message(self, format, *args):
+                # Requests are counted instead of logged
+                pass
+
+        return RequestHandler
+
+    def get_metrics(self) -> dict:
+        """Get the requests answered by path and the errors injected"""
+        with self._lock:
+            return {
+                "requests": sum(self.requests.values()),
+                "errors": self.errors,
+                "by_path": dict(self.requests),
+            }
+
+
+def json_response(data) -> tuple:
+    return 200, "application/json", json.dumps(data).encode()
+
+
+def create_glue_api_handler(market):
+    """Answer listing searches with the pages of a synthetic market"""
+
+    def handler(method, path, params, body):
+        if path != "/v2/listings":
+            return 404, "text/plain", b"Not found"
+        return json_response(market.get_page_data(params))
+
+    return handler
+
+
+def create_satellite_image(size: int = 1000, seed: int = 0) -> bytes:
+    """Create a PNG with patches of vegetation, the size of a Mapbox @2x image"""
+    generator = np.random.default_rng(seed)
+    pixels = generator.integers(60, 140, size=(size, size, 3), dtype=np.uint8)
+    # A third of the image is green
+    pixels[: size // 3, :, 1] = generator.integers(140, 220, size=(size // 3, size), dtype=np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def create_mapbox_handler():
+    """Answer static image requests with the same satellite image"""
+    image = create_satellite_image()
+
+    def handler(method, path, params, body):
+        if "/static/" not in path:
+            return 404, "text/plain", b"Not found"
+        return 200, "image/png", image
+
+    return handler
+
+
+def create_overpass_handler(seed: int = 0):
+    """Answer Overpass queries with a few bus routes and parks"""
+    generator = random.Random(seed)
+    lock = threading.Lock()
+
+    def handler(method, path, params, body):
+        with lock:
+            n_relations = generator.randint(0, 12)
+            has_park = generator.random() < 0.3
+        elements = [
+            {"type": "relation", "id": number, "members": [], "tags": {"route": "bus"}}
+            for number in range(n_relations)
+        ]
+        if has_park:
+            elements.append(
+                {"type": "way", "id": 1, "nodes": [], "tags": {"leisure": "park", "name": "Parque Central"}}
+            )
+        return json_response({"version": 0.6, "generator": "stand-in", "elements": elements})
+
+    return handler
+
+
+def create_brasil_aberto_handler():
+    """Answer zip code lookups with a street number range"""
+
+    def handler(method, path, params, body):
+        if path.startswith("/v1/zipcode/"):
+            zip_code = path.rsplit("/", 1)[-1].split(".")[0]
+            start = int(zip_code[-3:]) * 2 + 1
+            return json_response({"result": {"complement": f"de {start} a {start + 200} - lado ímpar"}})
+        if path.startswith("/v1/districts/"):
+            return json_response({"result": []})
+        return 404, "text/plain", b"Not found"
+
+    return handler
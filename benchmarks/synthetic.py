@@ -0,0 +1,172 @@
+import hashlib
+import random
+from datetime import datetime, timedelta, timezone
+
+# Words mixed into titles, some of them matching the description flags
+TITLE_WORDS = [
+    "Apartamento",
+    "amplo",
+    "reformado",
+    "mobiliado",
+    "com varanda",
+    "com piscina",
+    "vista para o mar",
+    "próximo ao metrô",
+    "andar alto",
+    "ensolarado",
+]
+STREET_TYPES = ["Rua", "Rua", "Rua", "Avenida", "Alameda"]
+
+
+class SyntheticMarket:
+    """
+    Deterministic listings of every neighborhood of a market, shaped like the
+    glue-api results, so the same search returns the same page on every run
+    """
+
+    def __init__(
+        self,
+        state: str = "SP",
+        city: str = "São Paulo",
+        listings_per_neighborhood: int = 500,
+        missing_street_number_rate: float = 0.2,
+        seed: int = 0,
+    ):
+        """
+        Args:
+            state (str): State acronym of the listings
+            city (str): City of the listings
+            listings_per_neighborhood (int): Listings generated for each neighborhood
+            missing_street_number_rate (float): Share of listings without a street
+                number, whose zip code is looked up on Brasil Aberto
+            seed (int): Seed of the generator
+        """
+        self.state = state
+        self.city = city
+        self.listings_per_neighborhood = listings_per_neighborhood
+        self.missing_street_number_rate = missing_street_number_rate
+        self.seed = seed
+        self.now = datetime(2024, 6, 1, tzinfo=timezone.utc)
+        self._listings = {}
+
+    def get_random(self, *keys) -> random.Random:
+        """Get a random generator seeded by the keys"""
+        digest = hashlib.sha256("|".join(map(str, (self.seed, *keys))).encode()).hexdigest()
+        return random.Random(int(digest[:16], 16))
+
+    def get_listings(self, neighborhood: str, business_type: str) -> list:
+        """Get the listings of a neighborhood, most recently updated first"""
+        key = (neighborhood, business_type)
+        if key not in self._listings:
+            generator = self.get_random(neighborhood, business_type)
+            # Neighborhoods are spread around the city center, 2 km wide
+            center_lat = -23.55 + generator.uniform(-0.1, 0.1)
+            center_lon = -46.63 + generator.uniform(-0.1, 0.1)
+            zip_codes = [f"0{generator.randint(1000000, 5999999)}" for _ in range(40)]
+            # Listing ids are unique across neighborhoods and business types
+            id_prefix = generator.randint(100000, 999999)
+            listings = [
+                self.create_listing(
+                    generator, neighborhood, f"{id_prefix}{number:05d}", business_type,
+                    center_lat, center_lon, zip_codes,
+                )
+                for number in range(self.listings_per_neighborhood)
+            ]
+            listings.sort(key=lambda listing: listing["listing"]["updatedAt"], reverse=True)
+            self._listings[key] = listings
+        return self._listings[key]
+
+    def create_listing(
+        self, generator, neighborhood, source_id, business_type, center_lat, center_lon, zip_codes
+    ) -> dict:
+        """Create a listing result as returned by glue-api"""
+        area = generator.randint(30, 250)
+        bedrooms = max(1, min(5, area // 40))
+        if business_type == "SALE":
+            price = int(area * generator.uniform(6000, 18000))
+            pricing = {"businessType": "SALE", "price": str(price), "monthlyCondoFee": str(area * 10)}
+        else:
+            price = int(area * generator.uniform(30, 90))
+            pricing = {
+                "businessType": "RENTAL",
+                "price": str(price),
+                "monthlyCondoFee": str(area * 10),
+                "rentalInfo": {"monthlyRentalTotalPrice": str(price)},
+            }
+        created_at = self.now - timedelta(days=generator.randint(0, 365))
+        updated_at = created_at + (self.now - created_at) * generator.random()
+        street = f"{generator.choice(STREET_TYPES)} {generator.choice(['das Flores', 'Augusta', 'Paulista', 'Harmonia', 'Bela Cintra'])}"
+        street_number = (
+            "" if generator.random() < self.missing_street_number_rate else str(generator.randint(1, 3000))
+        )
+        title = " ".join(generator.sample(TITLE_WORDS, 3))
+        return {
+            "listing": {
+                "sourceId": source_id,
+                "title": f"{title} em {neighborhood}",
+                "createdAt": created_at.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                "updatedAt": updated_at.strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+                "unitTypes": ["APARTMENT"],
+                "usableAreas": [str(area)],
+                "bedrooms": [bedrooms],
+                "bathrooms": [max(1, bedrooms - 1)],
+                "parkingSpaces": [generator.randint(0, 3)],
+                "unitFloor": str(generator.randint(0, 25)),
+                "deliveredAt": f"{generator.randint(1970, 2024)}-01-01T00:00:00Z",
+                "pricingInfos": [pricing],
+                "address": {
+                    "city": self.city,
+                    "neighborhood": neighborhood,
+                    "stateAcronym": self.state,
+                    "zipCode": generator.choice(zip_codes),
+                    "country": "Brasil",
+                    "point": {
+                        "lat": center_lat + generator.uniform(-0.01, 0.01),
+                        "lon": center_lon + generator.uniform(-0.01, 0.01),
+                    },
+                },
+            },
+            "account": {
+                "name": f"Imobiliária {generator.randint(1, 200)}",
+                "licenseNumber": "" if generator.random() < 0.05 else str(generator.randint(10000, 99999)),
+                "createdDate": (created_at - timedelta(days=generator.randint(0, 2000))).strftime(
+                    "%Y-%m-%dT%H:%M:%SZ"
+                ),
+                "phones": {"primary": f"119{generator.randint(10000000, 99999999)}"},
+            },
+            "link": {
+                "href": f"/imovel/{source_id}/",
+                "data": {"street": street, "streetNumber": street_number},
+            },
+        }
+
+    @staticmethod
+    def get_price(listing: dict) -> int:
+        """Get the price a search filters a listing by"""
+        pricing = listing["listing"]["pricingInfos"][0]
+        if pricing["businessType"] == "RENTAL":
+            return int(pricing["rentalInfo"]["monthlyRentalTotalPrice"])
+        return int(pricing["price"])
+
+    def get_page_data(self, params: dict) -> dict:
+        """
+        Get the response of a glue-api search
+        Args:
+            params (dict): Query parameters of the search, with a single value each
+        """
+        listings = self.get_listings(params.get("addressNeighborhood", ""), params.get("business", "SALE"))
+        min_price = int(params.get("priceMin") or 0)
+        max_price = int(params.get("priceMax") or 10**12)
+        found = [listing for listing in listings if min_price <= self.get_price(listing) <= max_price]
+        if not params.get("sort", "").startswith("updatedAt"):
+            # Default relevance order, stable across requests
+            found = sorted(found, key=lambda listing: listing["listing"]["sourceId"])
+        start = int(params.get("from") or 0)
+        size = int(params.get("size") or 100)
+        return {
+            "search": {
+                "totalCount": len(found),
+                "result": {"listings": found[start:start + size]},
+            },
+            "page": {"uriCategory": {"page": start // max(size, 1) + 1}},
+        }
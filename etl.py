@@ -1,46 +1,177 @@
 # ETL pipeline to extract listings from ZAP Imóveis website,
 # process them and save to the database
-from src.classes import ZapPage, ZapNeighborhood, ZapItem
+from src.classes import ZapNeighborhood, ZapItem
 from dotenv import load_dotenv
-from src import extract, transform
+from src import extract, transform, migrations
+from src.checkpoint import RunCheckpoint, cleanup_stale_runs, get_run_id
+from src.database import db_manager, bulk_loader, partition_manager, RunStagingTable
+from src.enrichment import image_analysis_index, traffic_analysis_index
+from src.http_client import http_client
+from src.job_queue import LeaseHeartbeat, get_worker_id, job_queue
+from src.proxy_pool import glue_api_proxy_pool
+from src.resilience import Deadline
+from src.scheduler import NeighborhoodScheduler
+from src.tracing import tracer
+from src.watermarks import NeighborhoodWatermarks
+from src.writer import BackgroundDatabaseWriter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
 import logging
-import random
+import os
+import sys
+import time
 
 # Configure logging
 logging.basicConfig(format="%(asctime)s %(name)-12s %(levelname)-8s %(message)s", level=logging.INFO)
 # Create logger object
 logger = logging.getLogger(__name__)
 
-def main(
+
+def scrape_neighborhood(zap_neighborhood, deadline):
+    """
+    Scrape every page of a neighborhood and clean its listings
+    Args:
+        zap_neighborhood (ZapNeighborhood): Search of the neighborhood
+        deadline (Deadline): Time budget of the neighborhood
+    Returns:
+        Whether all pages were scraped within the budget
+    """
+    neighborhood = zap_neighborhood.neighborhood
+    scraped_all_pages = True
+    # Get existing listing ids from a neighborhood
+    zap_neighborhood.get_existing_ids()
+    # Get existing zip codes from a neighborhood
+    zap_neighborhood.get_existing_zip_codes()
+    # Get image analysis for a neighborhood
+    zap_neighborhood.get_image_analysis()
+    # Get traffic analysis for a neighborhood
+    zap_neighborhood.get_traffic_analysis()
+    # Iterate through all pages on a neighborhood, fetched in parallel lanes
+    for zap_page in zap_neighborhood.get_pages():
+        if deadline.expired():
+            logger.warning(f"\tNeighborhood budget spent, stopping {neighborhood} at page {zap_page.page_number}")
+            scraped_all_pages = False
+            break
+        logger.info(f"\tParsing page {zap_page.page_number} on {neighborhood}")
+        # Resolve missing zip codes of the page concurrently
+        zap_page.prefetch_zip_codes()
+        # Create ZapItem object for each item in a page
+        with tracer.span(
+            "item_parse", neighborhood=neighborhood, page=zap_page.page_number, rows=len(zap_page.listings)
+        ):
+            for listing in zap_page.listings:
+                try:
+                    item = ZapItem(listing, zap_page)
+                    zap_page.add_zap_item(item)
+                except Exception as e:
+                    logger.error(e)
+                    continue
+        # Save items to ZapSearch
+        zap_neighborhood.append_zap_page(zap_page)
+    if zap_neighborhood.failed_pages:
+        logger.warning(f"\t{zap_neighborhood.failed_pages} pages of {neighborhood} failed, keeping unseen listings")
+        scraped_all_pages = False
+    # Convert output to standard format before saving
+    zap_neighborhood.concat_zip_codes()
+    zap_neighborhood.concat_listings()
+    # Treating listings
+    zap_neighborhood.remove_fraudsters()
+    zap_neighborhood.remove_outliers()
+    zap_neighborhood.remove_duplicated_listings()
+    # highlight good deals
+    zap_neighborhood.calculate_price_per_area_first_quartile()
+    return scraped_all_pages
+
+
+def run_market(
+    state,
+    city,
+    unit_type,
+    unit_type_v3,
+    unit_subtype,
+    business_type,
+    neighborhoods,
+    run_deadline,
     min_area: int = 30,
     min_price: int = 200000,
     max_price: int = 2000000,
+    run_id=None,
 ):
     """
-    Perform a search on ZapImvoeis based on filters, scraping listings,
-    processing them and saving the output to a database
+    Scrape all neighborhoods of a market and publish its listings
     Args:
+        state (str): State to scrape
+        city (str): City to scrape
+        unit_type (str): Unit types searched, as returned by extract.get_unit_type
+        unit_type_v3 (str): Unit types v3 searched
+        unit_subtype (str): Unit subtypes searched
         business_type (str): Type of business, SALE or RENTAL
-        max_price (int): Max price to scrape
+        neighborhoods (list): Neighborhoods to scrape
+        run_deadline (Deadline): Time budget of the whole run
         min_area (int): Min area to scrape
         min_price (int): Min listing price to scrape
-        unit_type (str): Type of construction, APARTMENT or HOME
+        max_price (int): Max price to scrape
+        run_id (str): Id of the run, restarting a run with the same id resumes it
+            from its checkpoints
     """
-
-    # Load credential values
-    load_dotenv()
-    # Get state, city and neighborhoods to be search through command prompt
-    state, city, unit_type, unit_type_v3, unit_subtype, business_type, neighborhoods = extract.get_search_parameters()
-    # Generate a random integer between 0 and 1000000 for session number
-    session_number = random.randint(0, 1000000)
+    logger.info(f"Running for {business_type} on {len(neighborhoods)} neighborhoods in {state} - {city}")
+    market_unit_type = unit_type.split(",")[0]
+    checkpoint = RunCheckpoint(db_manager, run_id or get_run_id(), city, business_type, market_unit_type)
+    checkpoints = checkpoint.load()
+    if checkpoint.is_published(checkpoints):
+        logger.info(f"Market already published on run {checkpoint.run_id}, skipping it")
+        return
+    # Same session number on every attempt of the run, so its staging table is reused
+    session_number = checkpoint.get_session_number()
     if business_type == "RENTAL":
         max_price = int(max_price/100)
         min_price = int(min_price/100)
+    # All neighborhoods are loaded into a run-scoped staging table
+    # and published to fact_listings at once by the end of the run. It is logged,
+    # so neighborhoods checkpointed as saved still have their rows after a crash
+    run_staging = RunStagingTable(
+        db_manager, bulk_loader, session_number, partition_manager=partition_manager, logged=True
+    )
+    run_staging.create()
+    # Neighborhoods saved on an earlier attempt of the run are kept on the staging table
+    checkpoint.restore(checkpoints, run_staging)
+    # Neighborhoods whose pages were all scraped, with whether they were fully swept.
+    # Saved neighborhoods can only be expired after a full sweep
+    fully_scraped_neighborhoods = {
+        neighborhood: row["completed"]
+        for neighborhood, row in checkpoints.items()
+        if row["scraped_all_pages"]
+    }
+    # Start of the run, moved back to when its first attempt saved a neighborhood
+    run_started_at = min(
+        [datetime.now(timezone.utc), *(row["updated_at"] for row in checkpoints.values())]
+    )
+    neighborhoods = [neighborhood for neighborhood in neighborhoods if neighborhood not in checkpoints]
+    # Delta runs only page through listings updated since each neighborhood's watermark
+    watermarks = NeighborhoodWatermarks(db_manager)
+    delta_watermarks = watermarks.get_delta_watermarks(
+        city, business_type, market_unit_type, neighborhoods
+    )
+    # Unit types covered by the search, as stored on listings
+    searched_unit_types = sorted(set(unit_type.split(",")) | set(unit_type_v3.split(",")))
+    # Saves run on a background thread while the next neighborhood is scraped
+    writer = BackgroundDatabaseWriter()
+    # Neighborhoods expected to change the most per second of scraping go first
+    scheduler = NeighborhoodScheduler(db_manager)
+    neighborhoods = scheduler.plan(
+        city, business_type, market_unit_type, neighborhoods, run_deadline.remaining()
+    )
 
     for neighborhood in neighborhoods:
+        if run_deadline.expired():
+            logger.warning(f"Run budget spent, skipping neighborhood {neighborhood} and the next ones")
+            break
         logger.info(f"Getting listings from neighborhood {neighborhood}")
-        # Start from page_number 0
-        page_number = 0
+        # Time budget of the neighborhood, capped by what is left of the run's
+        neighborhood_deadline = Deadline.from_env(
+            "ETL_NEIGHBORHOOD_BUDGET_SECONDS", parent=run_deadline
+        )
+        watermark = delta_watermarks[neighborhood]
         # Initialize a ZapSearch item that
         # consists of searching a whole neighborhood
         zap_neighborhood = ZapNeighborhood(
@@ -54,62 +185,285 @@ def main(
             max_price,
             min_price,
             min_area,
-            session_number
+            session_number,
+            run_staging=run_staging,
+            deadline=neighborhood_deadline,
+            checkpoint=checkpoint,
+            watermark=watermark,
+        )
+        start = time.monotonic()
+        scraped_all_pages = scrape_neighborhood(zap_neighborhood, neighborhood_deadline)
+        last_scraped = scheduler.last_scraped.get(neighborhood)
+        # Keep the cost and churn of the neighborhood to schedule the next runs
+        writer.submit(
+            f"history of {neighborhood}",
+            scheduler.record,
+            city,
+            business_type,
+            market_unit_type,
+            neighborhood,
+            duration_seconds=time.monotonic() - start,
+            n_pages=len(zap_neighborhood.zap_pages),
+            n_listings=len(zap_neighborhood.listings_to_add),
+            n_changed=zap_neighborhood.count_changed_listings(
+                None if last_scraped is None else last_scraped.date()
+            ),
+            completed=scraped_all_pages,
+            delta=watermark is not None,
+        )
+        # Save results to db on the background writer
+        zap_neighborhood.submit_saves_to_writer(writer)
+        # Listings missing from a fully swept neighborhood can be expired, partially
+        # scraped ones and delta runs keep their listings until a complete sweep
+        completed = scraped_all_pages and watermark is None
+        if completed:
+            writer.submit(
+                f"completion of {neighborhood}", run_staging.mark_neighborhood_complete, neighborhood
+            )
+        if scraped_all_pages:
+            fully_scraped_neighborhoods[neighborhood] = watermark is None
+        # Once its listings are saved, restarts of the run skip the neighborhood
+        writer.submit(
+            f"checkpoint of {neighborhood}",
+            checkpoint.mark_saved,
+            neighborhood,
+            completed,
+            scraped_all_pages,
+            run_staging.loaded_columns,
         )
-        # Delete listings that are not available
-        zap_neighborhood.remove_old_listings()
-        # Get existing listing ids from a neighborhood
-        zap_neighborhood.get_existing_ids()
-        # Get existing zip codes from a neighborhood
-        zap_neighborhood.get_existing_zip_codes()
-        # Get image analysis for a neighborhood
-        zap_neighborhood.get_image_analysis()
-        # Get traffic analysis for a neighborhood
-        zap_neighborhood.get_traffic_analysis()
-        # Iterate through all pages on a neighborhood
-        while True:
-            logger.info(f"\tGetting page {page_number} on {neighborhood}")
-            # Initialize a ZapPage object with data for each page_number
-            # searched
-            zap_page = ZapPage(page_number, zap_neighborhood)
-            # Get response for API call on a page_number
-            zap_page.get_page()
-            # Get all listings from a ZapPage
-            zap_page.get_listings()
-            # Create ZapItem object for each item in a page
-            for listing in zap_page.listings:
-                try:
-                    item = ZapItem(listing, zap_page)
-                    zap_page.add_zap_item(item)
-                except Exception as e:
-                    logger.error(e)
-                    continue
-            # Save items to ZapSearch
-            zap_neighborhood.append_zap_page(zap_page)
-            # If there number of listings reached the total, finish the search
-            if zap_page.check_if_search_ended():
-                break
-            # Go to next page
-            page_number += 1
-        # Convert output to standard format before saving
-        zap_neighborhood.concat_zip_codes()
-        zap_neighborhood.concat_listings()
-        # Treating listings
-        zap_neighborhood.remove_fraudsters()
-        zap_neighborhood.remove_outliers()
-        zap_neighborhood.remove_duplicated_listings()
-        # highlight good deals
-        zap_neighborhood.calculate_price_per_area_first_quartile()
-        # Save results to db
-        zap_neighborhood.save_image_analysis_to_db()
-        zap_neighborhood.save_traffic_analysis_to_db()
-        zap_neighborhood.save_listings_to_db()
-        zap_neighborhood.save_zip_codes_to_db()
         # Close engine
         zap_neighborhood.close_engine()
-    transform.group_green_density(city)
-    transform.group_n_bus_lanes(city)
-    transform.flag_remodeled_properties()
+    # Wait for pending saves, raising here if any of them failed
+    writer.close()
+    # Insert, update and expire listings of all neighborhoods in a single transaction
+    run_staging.publish(city, business_type, searched_unit_types)
+    checkpoint.mark_published()
+    run_staging.drop()
+    # Watermarks only move on neighborhoods whose pages were all scraped, skipped
+    # and partially scraped ones keep theirs, otherwise their next delta run could
+    # miss changes
+    watermarks.record(
+        city, business_type, market_unit_type, run_started_at, fully_scraped_neighborhoods
+    )
+    # Fill features left pending by open circuits or spent budgets, on this or earlier runs
+    transform.backfill_pending_enrichment(city, business_type, deadline=run_deadline)
+    # Group green density and bus lanes and flag remodeled listings in one pass
+    transform.update_derived_columns(city, business_type)
+
+
+def run_manifest_market(market, run_deadline, run_id=None, **search_filters):
+    """
+    Run a market of a manifest. Its parameters, and neighborhoods when not listed,
+    are resolved on the market's own thread, so their errors only fail this market
+    """
+    run_market(
+        *extract.get_market_parameters(market), run_deadline, run_id=run_id, **search_filters
+    )
+
+
+def run_manifest(path, run_deadline, run_id=None, **search_filters):
+    """
+    Run every market of a manifest in this process, so they share the database pool,
+    caches, enrichment index, rate limiters and proxy pool
+    Args:
+        path (str): Path to the run manifest
+        run_deadline (Deadline): Time budget of the whole run
+        run_id (str): Id of the run, shared by its markets
+        search_filters: Area and price filters passed to run_market
+    """
+    manifest = extract.load_manifest(path)
+    markets = manifest["markets"]
+    # Markets scraped at the same time across the process
+    max_concurrent_markets = int(
+        os.getenv("ETL_MAX_CONCURRENT_MARKETS", manifest.get("max_concurrent_markets", 2))
+    )
+    logger.info(f"Running {len(markets)} markets, {max_concurrent_markets} at a time")
+    failed_markets = []
+    with ThreadPoolExecutor(max_workers=max_concurrent_markets) as executor:
+        futures = {
+            executor.submit(
+                run_manifest_market, market, run_deadline, run_id=run_id, **search_filters
+            ): market
+            for market in markets
+        }
+        for future in as_completed(futures):
+            market = futures[future]
+            description = f"{market['unit_type']} {market['business_type']} in {market['city']}"
+            try:
+                future.result()
+                logger.info(f"Finished {description}")
+            except Exception as error:
+                # A failing market doesn't stop the other ones
+                logger.error(f"Failed {description}: {error}")
+                failed_markets.append(description)
+    if failed_markets:
+        raise RuntimeError(f"Failed markets: {', '.join(failed_markets)}")
+
+
+def run_job(job, worker_id, min_area: int = 30):
+    """
+    Scrape the neighborhood of a job from the queue and publish its listings
+    Args:
+        job (dict): Job claimed from the queue
+        worker_id (str): Worker holding the lease of the job
+        min_area (int): Min area to scrape
+    Returns:
+        Summary of the job, saved as its result
+    """
+    city, business_type, neighborhood = job["city"], job["business_type"], job["neighborhood"]
+    searched_unit_type = extract.get_unit_type(job["unit_type"])
+    # Each job has its own staging table, named after the job
+    run_staging = RunStagingTable(
+        db_manager, bulk_loader, job["id"], partition_manager=partition_manager
+    )
+    run_staging.create()
+    writer = BackgroundDatabaseWriter()
+    scheduler = NeighborhoodScheduler(db_manager)
+    history = scheduler.get_history(city, business_type, job["unit_type"])
+    history = history[history["neighborhood"] == neighborhood]
+    last_scraped = history["scraped_at"].max() if not history.empty else None
+    neighborhood_deadline = Deadline.from_env("ETL_NEIGHBORHOOD_BUDGET_SECONDS")
+    zap_neighborhood = ZapNeighborhood(
+        job["state"],
+        city,
+        neighborhood,
+        searched_unit_type,
+        extract.get_unit_type_v3(job["unit_type"]),
+        extract.get_unit_subtype(job["unit_type"]),
+        business_type,
+        job["max_price"],
+        job["min_price"],
+        min_area,
+        job["id"],
+        run_staging=run_staging,
+        deadline=neighborhood_deadline,
+    )
+    try:
+        start = time.monotonic()
+        with LeaseHeartbeat(job_queue, job["id"], worker_id) as heartbeat:
+            scraped_all_pages = scrape_neighborhood(zap_neighborhood, neighborhood_deadline)
+            duration_seconds = time.monotonic() - start
+            summary = {
+                "n_pages": len(zap_neighborhood.zap_pages),
+                "n_listings": len(zap_neighborhood.listings_to_add),
+                "n_changed": zap_neighborhood.count_changed_listings(
+                    None if last_scraped is None else last_scraped.date()
+                ),
+                "completed": scraped_all_pages,
+            }
+            writer.submit(
+                f"history of {neighborhood}",
+                scheduler.record,
+                city,
+                business_type,
+                job["unit_type"],
+                neighborhood,
+                duration_seconds=duration_seconds,
+                **summary,
+            )
+            zap_neighborhood.submit_saves_to_writer(writer)
+            if scraped_all_pages:
+                writer.submit(
+                    f"completion of {neighborhood}", run_staging.mark_neighborhood_complete, neighborhood
+                )
+            writer.close()
+            # Another worker took the job over, so it publishes the listings instead
+            if heartbeat.lost_lease:
+                raise RuntimeError(f"Lost the lease of job {job['id']}")
+            # Only listings within the price range of the job are expired
+            counts = run_staging.publish(
+                city,
+                business_type,
+                zap_neighborhood.get_searched_unit_types(),
+                price_range=(job["min_price"], job["max_price"]),
+            )
+        return {**summary, "duration_seconds": duration_seconds, **counts}
+    finally:
+        run_staging.drop()
+        zap_neighborhood.close_engine()
+
+
+def run_worker(worker_id, run_id=None, min_area: int = 30):
+    """
+    Claim and run jobs from the queue until there are none left. The worker
+    finishing the last job of a market also backfills and derives its columns
+    Args:
+        worker_id (str): Id of this worker
+        run_id (str): If given, only jobs of this run are claimed
+        min_area (int): Min area to scrape
+    """
+    logger.info(f"Worker {worker_id} started")
+    n_jobs = 0
+    while True:
+        job = job_queue.claim(worker_id, run_id)
+        if job is None:
+            break
+        n_jobs += 1
+        description = f"{job['neighborhood']} {job['unit_type']} {job['business_type']} in {job['city']}"
+        logger.info(f"Running job {job['id']}, attempt {job['attempts']}: {description}")
+        try:
+            result = run_job(job, worker_id, min_area=min_area)
+            job_queue.complete(job["id"], worker_id, result)
+        except Exception as error:
+            logger.error(f"Failed job {job['id']}: {error}")
+            job_queue.fail(job["id"], worker_id, repr(error))
+            continue
+        if job_queue.is_market_done(job["run_id"], job["city"], job["business_type"], job["unit_type"]):
+            logger.info(f"Finished market {job['unit_type']} {job['business_type']} in {job['city']}")
+            transform.backfill_pending_enrichment(job["city"], job["business_type"])
+            transform.update_derived_columns(job["city"], job["business_type"])
+    logger.info(f"Worker {worker_id} ran {n_jobs} jobs, no jobs left")
+
+
+def main(
+    min_area: int = 30,
+    min_price: int = 200000,
+    max_price: int = 2000000,
+):
+    """
+    Perform a search on ZapImvoeis based on filters, scraping listings,
+    processing them and saving the output to a database. Markets are read from
+    the command prompt, from a manifest with --manifest path, or from the job
+    queue with --worker [run_id]
+    Args:
+        max_price (int): Max price to scrape
+        min_area (int): Min area to scrape
+        min_price (int): Min listing price to scrape
+    """
+
+    # Load credential values
+    load_dotenv()
+    # Pages are only fetched through proxies, so fail before anything runs without them
+    glue_api_proxy_pool.ensure_configured("GLUE_API_PROXIES")
+    # Make sure tables and indexes used on hot paths are up to date
+    migrations.migrate()
+    # Time budget of the whole run, neighborhoods not started within it are skipped
+    run_deadline = Deadline.from_env("ETL_RUN_BUDGET_SECONDS")
+    search_filters = {"min_area": min_area, "min_price": min_price, "max_price": max_price}
+    # Restarting with the same ETL_RUN_ID resumes the run from its checkpoints
+    run_id = get_run_id()
+    logger.info(f"Starting run {run_id}")
+    # Staging tables and checkpoints of runs that were never resumed
+    cleanup_stale_runs(db_manager, run_id)
+    try:
+        if len(sys.argv) == 3 and sys.argv[1] == "--manifest":
+            run_manifest(sys.argv[2], run_deadline, run_id=run_id, **search_filters)
+        elif len(sys.argv) in (2, 3) and sys.argv[1] == "--worker":
+            # Run jobs from the queue, of a single run if its id is given
+            run_worker(get_worker_id(), *sys.argv[2:], min_area=min_area)
+        else:
+            # Get state, city and neighborhoods to be search through command prompt
+            run_market(
+                *extract.get_search_parameters(), run_deadline, run_id=run_id, **search_filters
+            )
+    finally:
+        # Report request rates, throttling and tiles reused across the run
+        http_client.log_metrics()
+        glue_api_proxy_pool.log_metrics()
+        logger.info(f"Image analysis index: {image_analysis_index.get_metrics()}")
+        logger.info(f"Traffic analysis index: {traffic_analysis_index.get_metrics()}")
+        # Time spent on each stage of the run
+        tracer.emit_report()
 
 if __name__ == "__main__":
 
@@ -18,6 +18,62 @@ load_dotenv()
 mapbox_token = os.environ["MAPBOX_TOKEN"]
 
 
+def get_listing_filters_mask(
+    data,
+    neighborhood,
+    location_type,
+    unit_type,
+    number_bedrooms,
+    area,
+    price,
+    price_per_area,
+    green_density,
+    movement_intensity,
+    is_remodeled,
+):
+    """
+    Get which listings match the filters of the sidebar
+    Args:
+        data (pd.DataFrame): Listings of the market
+        neighborhood (list): Neighborhoods selected
+        location_type (list): Location types selected
+        unit_type (list): Unit types selected, "Apartamentos" and/or "Casas"
+        number_bedrooms (int): Minimum number of bedrooms
+        area (tuple): Minimum and maximum total area
+        price (int): Maximum price
+        price_per_area (int): Maximum price per area
+        green_density (list): Green density groups selected
+        movement_intensity (list): Bus lanes groups selected
+        is_remodeled (bool): Whether only remodeled listings are shown
+    Returns:
+        Boolean series, True for the listings to show
+    """
+    # Determine the condition based on the selection
+    if unit_type == ["Apartamentos"]:
+        unit_type_filter = data["unit_type"].isin(["APARTMENT", "FLAT", "PENTHOUSE"])
+    elif unit_type == ["Casas"]:
+        unit_type_filter = data["unit_type"].isin(["HOME", "CONDOMINIUM"])
+    else:
+        unit_type_filter = True  # Show all rows
+    if is_remodeled:
+        is_remodeled_filter = data["is_remodeled"] == True
+    else:
+        is_remodeled_filter = True
+    return (
+        (data["neighborhood"].isin(neighborhood))
+        & (data["location_type"].isin(location_type))
+        & (data["bedrooms"] >= number_bedrooms)
+        & (data["price_per_area"] <= price_per_area)
+        & (data["price"] <= price)
+        & (data["total_area_m2"] >= area[0])
+        & (data["total_area_m2"] <= area[1])
+        & (data["green_density_grouped"].isin(green_density))
+        & (data["n_nearby_bus_lanes_grouped"].isin(movement_intensity))
+        & (unit_type_filter)
+        & (is_remodeled_filter)
+    )
+
+
 class App:
     """
     Visualizer class that takes care of the visualization of the app.
@@ -181,17 +237,6 @@ class App:
                         placeholder="Apartamentos e Casas",
                         label_visibility="collapsed",
                     )
-                    # Determine the condition based on the selection
-                    if unit_type == ["Apartamentos"]:
-                        unit_type_filter = self.data["unit_type"].isin(
-                            ["APARTMENT", "FLAT", "PENTHOUSE"]
-                        )
-                    elif unit_type == ["Casas"]:
-                        unit_type_filter = self.data["unit_type"].isin(
-                            ["HOME", "CONDOMINIUM"]
-                        )
-                    else:
-                        unit_type_filter = True  # Show all rows
                     st.divider()
                     st.markdown("Número de quartos")
                     number_bedrooms = st.selectbox(
@@ -303,27 +348,23 @@ class App:
                     st.divider()
                     st.markdown("Reformado")
                     is_remodeled = st.checkbox("Reformado", key="is_remodeled")
-                    if is_remodeled:
-                        is_remodeled_filter = self.data["is_remodeled"] == True
-                    else:
-                        is_remodeled_filter = True
 
                 submit = st.form_submit_button("Filtrar anúncios", type="primary")
 
             if submit:
                 self.filtered_data = self.data.loc[
-                    (
-                        (self.data["neighborhood"].isin(neighborhood))
-                        & (self.data["location_type"].isin(location_type))
-                        & (self.data["bedrooms"] >= number_bedrooms)
-                        & (self.data["price_per_area"] <= price_per_area)
-                        & (self.data["price"] <= price)
-                        & (self.data["total_area_m2"] >= area[0])
-                        & (self.data["total_area_m2"] <= area[1])
-                        & (self.data["green_density_grouped"].isin(green_density))
-                        & (self.data["n_nearby_bus_lanes_grouped"].isin(movement_intensity))
-                        & (unit_type_filter)
-                        & (is_remodeled_filter)
+                    get_listing_filters_mask(
+                        self.data,
+                        neighborhood=neighborhood,
+                        location_type=location_type,
+                        unit_type=unit_type,
+                        number_bedrooms=number_bedrooms,
+                        area=area,
+                        price=price,
+                        price_per_area=price_per_area,
+                        green_density=green_density,
+                        movement_intensity=movement_intensity,
+                        is_remodeled=is_remodeled,
                     )
                 ]
             else:
@@ -0,0 +1,283 @@
+import json
+import logging
+import os
+import uuid
+import zlib
+from typing import Optional
+
+from sqlalchemy import text
+
+# Configure logging
+logging.basicConfig(
+    format="%(asctime)s %(name)-12s %(levelname)-8s %(message)s", level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+
+class RunCheckpoint:
+    """
+    Durable progress of a market on a run. Pages are kept as they are fetched
+    and neighborhoods once their listings are saved to the run staging table, so
+    a run restarted with the same id skips saved neighborhoods and resumes the
+    interrupted one from its fetched pages, without requesting them again
+    """
+
+    SAVED = "saved"
+    PUBLISHED = "published"
+
+    def __init__(self, db_manager, run_id: str, city: str, business_type: str, unit_type: str):
+        """
+        Args:
+            db_manager: Database manager
+            run_id (str): Id of the run, the same on every attempt of a run
+            city (str): City of the market
+            business_type (str): Business type of the market
+            unit_type (str): Unit type of the market, APARTMENT or HOME
+        """
+        self.db_manager = db_manager
+        self.run_id = run_id
+        self.market = {
+            "run_id": run_id,
+            "city": city,
+            "business_type": business_type,
+            "unit_type": unit_type,
+        }
+
+    def get_session_number(self) -> int:
+        """Get a session number that is the same on every attempt of the market's run"""
+        return zlib.crc32("|".join(self.market.values()).encode())
+
+    def load(self) -> dict:
+        """
+        Get the neighborhoods of the market already saved on the run
+        Returns:
+            Dictionary by neighborhood with status, completed, scraped_all_pages,
+            loaded_columns and updated_at
+        """
+        with self.db_manager.get_connection() as conn:
+            rows = conn.execute(
+                text(
+                    """
+                    SELECT
+                        neighborhood, status, completed, scraped_all_pages,
+                        loaded_columns, updated_at
+                    FROM etl_run_checkpoints
+                    WHERE run_id = :run_id
+                        AND city = :city
+                        AND business_type = :business_type
+                        AND unit_type = :unit_type
+                    """
+                ),
+                self.market,
+            ).mappings().all()
+        return {row["neighborhood"]: dict(row) for row in rows}
+
+    def is_published(self, checkpoints: dict) -> bool:
+        """Check if the market was already published on the run"""
+        return any(row["status"] == self.PUBLISHED for row in checkpoints.values())
+
+    def restore(self, checkpoints: dict, run_staging):
+        """Restore the saved neighborhoods and loaded columns on the run staging table"""
+        for neighborhood, row in checkpoints.items():
+            if row["completed"]:
+                run_staging.mark_neighborhood_complete(neighborhood)
+            for column in row["loaded_columns"]:
+                if column not in run_staging.loaded_columns:
+                    run_staging.loaded_columns.append(column)
+        if checkpoints:
+            logger.info(
+                f"Resuming run {self.run_id} with {len(checkpoints)} neighborhoods already saved"
+            )
+
+    @staticmethod
+    def get_price_band_key(price_band: Optional[tuple]) -> str:
+        """Get the key of a price band, empty for the whole price range"""
+        return "" if price_band is None else f"{price_band[0]}-{price_band[1]}"
+
+    def get_pages(self, neighborhood: str) -> dict:
+        """
+        Get the pages of a neighborhood fetched on an earlier attempt of the run
+        Returns:
+            Dictionary of page data by price band key and page number
+        """
+        with self.db_manager.get_connection() as conn:
+            rows = conn.execute(
+                text(
+                    """
+                    SELECT price_band, page_number, page_data
+                    FROM etl_run_pages
+                    WHERE run_id = :run_id
+                        AND city = :city
+                        AND business_type = :business_type
+                        AND unit_type = :unit_type
+                        AND neighborhood = :neighborhood
+                    """
+                ),
+                {**self.market, "neighborhood": neighborhood},
+            ).all()
+        if rows:
+            logger.info(f"\tResuming {neighborhood} from {len(rows)} pages already fetched")
+        return {(row.price_band, row.page_number): row.page_data for row in rows}
+
+    def save_page(self, neighborhood: str, price_band: Optional[tuple], page_number: int, page_data: dict):
+        """Keep a fetched page, so it isn't requested again if the run is restarted"""
+        with self.db_manager.get_transaction() as conn:
+            conn.execute(
+                text(
+                    """
+                    INSERT INTO etl_run_pages (
+                        run_id, city, business_type, unit_type, neighborhood,
+                        price_band, page_number, page_data
+                    )
+                    VALUES (
+                        :run_id, :city, :business_type, :unit_type, :neighborhood,
+                        :price_band, :page_number, CAST(:page_data AS jsonb)
+                    )
+                    ON CONFLICT DO NOTHING
+                    """
+                ),
+                {
+                    **self.market,
+                    "neighborhood": neighborhood,
+                    "price_band": self.get_price_band_key(price_band),
+                    "page_number": page_number,
+                    "page_data": json.dumps(page_data),
+                },
+            )
+
+    def mark_saved(
+        self, neighborhood: str, completed: bool, scraped_all_pages: bool, loaded_columns: list
+    ):
+        """
+        Record a neighborhood whose listings were saved to the run staging table,
+        dropping its pages, which won't be needed anymore
+        Args:
+            neighborhood (str): Neighborhood saved
+            completed (bool): Whether its missing listings can be expired
+            scraped_all_pages (bool): Whether all pages of its search were scraped
+            loaded_columns (list): Columns loaded to the run staging table so far
+        """
+        with self.db_manager.get_transaction() as conn:
+            conn.execute(
+                text(
+                    """
+                    INSERT INTO etl_run_checkpoints (
+                        run_id, city, business_type, unit_type, neighborhood,
+                        status, completed, scraped_all_pages, loaded_columns
+                    )
+                    VALUES (
+                        :run_id, :city, :business_type, :unit_type, :neighborhood,
+                        :status, :completed, :scraped_all_pages, :loaded_columns
+                    )
+                    ON CONFLICT (run_id, city, business_type, unit_type, neighborhood)
+                    DO UPDATE SET
+                        status = EXCLUDED.status,
+                        completed = EXCLUDED.completed,
+                        scraped_all_pages = EXCLUDED.scraped_all_pages,
+                        loaded_columns = EXCLUDED.loaded_columns,
+                        updated_at = now()
+                    """
+                ),
+                {
+                    **self.market,
+                    "neighborhood": neighborhood,
+                    "status": self.SAVED,
+                    "completed": completed,
+                    "scraped_all_pages": scraped_all_pages,
+                    "loaded_columns": list(loaded_columns),
+                },
+            )
+            conn.execute(
+                text(
+                    """
+                    DELETE FROM etl_run_pages
+                    WHERE run_id = :run_id
+                        AND city = :city
+                        AND business_type = :business_type
+                        AND unit_type = :unit_type
+                        AND neighborhood = :neighborhood
+                    """
+                ),
+                {**self.market, "neighborhood": neighborhood},
+            )
+
+    def mark_published(self):
+        """Record that the market was published, so restarts of the run skip it"""
+        with self.db_manager.get_transaction() as conn:
+            conn.execute(
+                text(
+                    """
+                    UPDATE etl_run_checkpoints
+                    SET status = :status, updated_at = now()
+                    WHERE run_id = :run_id
+                        AND city = :city
+                        AND business_type = :business_type
+                        AND unit_type = :unit_type
+                    """
+                ),
+                {**self.market, "status": self.PUBLISHED},
+            )
+
+
+def cleanup_stale_runs(db_manager, current_run_id: str, max_age_days: Optional[float] = None) -> int:
+    """
+    Drop the staging tables, checkpoints and pages of runs not resumed for a while,
+    which would otherwise be kept forever
+    Args:
+        db_manager: Database manager
+        current_run_id (str): Id of the run starting, whose checkpoints are kept
+        max_age_days (float): Days since a run was last updated for it to be dropped,
+            by default ETL_RUN_CHECKPOINT_DAYS or 7
+    Returns:
+        Number of markets of stale runs cleaned up
+    """
+    # Imported here, as the database module reads its configuration on import
+    from src.database import RunStagingTable
+
+    if max_age_days is None:
+        max_age_days = float(os.getenv("ETL_RUN_CHECKPOINT_DAYS", "7"))
+    with db_manager.get_connection() as conn:
+        markets = conn.execute(
+            text(
+                """
+                SELECT run_id, city, business_type, unit_type
+                FROM (
+                    SELECT run_id, city, business_type, unit_type, updated_at AS touched_at
+                    FROM etl_run_checkpoints
+                    UNION ALL
+                    SELECT run_id, city, business_type, unit_type, fetched_at
+                    FROM etl_run_pages
+                ) runs
+                WHERE run_id <> :run_id
+                GROUP BY run_id, city, business_type, unit_type
+                HAVING max(touched_at) < now() - make_interval(days => :max_age_days)
+                """
+            ),
+            {"run_id": current_run_id, "max_age_days": max_age_days},
+        ).mappings().all()
+    for market in markets:
+        checkpoint = RunCheckpoint(db_manager, **market)
+        # Dropped first, so a failure leaves the rows to find the table again
+        RunStagingTable(db_manager, None, checkpoint.get_session_number()).drop()
+        with db_manager.get_transaction() as conn:
+            for table in ["etl_run_pages", "etl_run_checkpoints"]:
+                conn.execute(
+                    text(
+                        f"""
+                        DELETE FROM {table}
+                        WHERE run_id = :run_id
+                            AND city = :city
+                            AND business_type = :business_type
+                            AND unit_type = :unit_type
+                        """
+                    ),
+                    checkpoint.market,
+                )
+    if markets:
+        logger.info(f"Cleaned up {len(markets)} markets of runs older than {max_age_days:g} days")
+    return len(markets)
+
+
+def get_run_id() -> str:
+    """Get the id of the run from ETL_RUN_ID, or a new one if it isn't set"""
+    return os.getenv("ETL_RUN_ID") or uuid.uuid4().hex
@@ -0,0 +1,73 @@
+import logging
+import threading
+from typing import Callable
+
+# Configure logging
+logging.basicConfig(
+    format="%(asctime)s %(name)-12s %(levelname)-8s %(message)s", level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+
+class EnrichmentIndex:
+    """
+    Process-wide index of analysis tiles computed during the run, shared by every
+    market and neighborhood, so a tile is only sent to the providers once even
+    before it is saved to the database
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._values = {}
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.computed = 0
+
+    def get(self, key):
+        """Get the value of a tile, or None if it wasn't computed yet"""
+        with self._lock:
+            return self._values.get(key)
+
+    def get_or_compute(self, key, compute: Callable) -> tuple:
+        """
+        Get the value of a tile, computing it if no other thread has. Concurrent
+        calls for the same tile wait for the first one instead of computing it again.
+        Errors raised by compute aren't cached, so the tile can be computed later
+        Args:
+            key: Tile key
+            compute: Callable returning the value of the tile
+        Returns:
+            Value of the tile, and whether it was computed by this call
+        """
+        while True:
+            with self._lock:
+                if key in self._values:
+                    self.hits += 1
+                    return self._values[key], False
+                event = self._in_flight.get(key)
+                if event is None:
+                    event = threading.Event()
+                    self._in_flight[key] = event
+                    break
+            # Another thread is computing the tile, check again once it is done
+            event.wait()
+        try:
+            value = compute()
+            with self._lock:
+                self._values[key] = value
+                self.computed += 1
+            return value, True
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+            event.set()
+
+    def get_metrics(self) -> dict:
+        """Get the size and hit counters of the index"""
+        with self._lock:
+            return {"tiles": len(self._values), "hits": self.hits, "computed": self.computed}
+
+
+image_analysis_index = EnrichmentIndex("image_analysis")
+traffic_analysis_index = EnrichmentIndex("traffic_analysis")
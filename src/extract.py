@@ -1,6 +1,9 @@
 import io
+import json
 import os
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import pandas as pd
 import requests as r
@@ -8,10 +11,11 @@ import streamlit as st
 from dotenv import load_dotenv
 from PIL import Image
 from sqlalchemy import  text
-import overpy
 import logging
 
-from src.database import db_manager
+from src.database import db_manager, reference_snapshot
+from src.http_client import http_client
+from src.resilience import CircuitOpenError
 
 # Configure logging
 logging.basicConfig(format="%(asctime)s %(name)-12s %(levelname)-8s %(message)s", level=logging.INFO)
@@ -22,12 +26,23 @@ logger = logging.getLogger(__name__)
 load_dotenv()
 
 def get_neighborhoods_from_city_and_state(state, city):
+    """
+    Get all neighborhood names for a given city from the local snapshot,
+    downloading them only when missing or outdated
+    """
+    return reference_snapshot.get_neighborhoods(
+        state, city, download_neighborhoods_from_city_and_state
+    )
+
+
+def download_neighborhoods_from_city_and_state(state, city):
     """
     Downloads all neighborhood names for a given city
     """
     city_id = get_city_id_from_city_and_state_names(state, city)
-    response = r.get(
-        f"https://api.brasilaberto.com/v1/districts/{city_id}",
+    response = http_client.get(
+        "brasil_aberto",
+        f"/v1/districts/{city_id}",
         headers={"Bearer": os.environ["BRASIL_ABERTO_API_KEY_PAID"]},
     )
     city_neighborhood_data = response.json()
@@ -110,7 +125,7 @@ def get_listings(business_type, city):
 
 def get_sat_image(min_lat, max_lat, min_lon, max_lon):
     # Define the URL template
-    url_template = "https://api.mapbox.com/styles/v1/{username}/{style_id}/static/[{min_lon},{min_lat},{max_lon},{max_lat}]/{width}x{height}@2x?access_token={access_token}"
+    url_template = "/styles/v1/{username}/{style_id}/static/[{min_lon},{min_lat},{max_lon},{max_lat}]/{width}x{height}@2x?access_token={access_token}"
 
     # Define the variable values
     username = "mapbox"
@@ -131,39 +146,32 @@ def get_sat_image(min_lat, max_lat, min_lon, max_lon):
         access_token=access_token
     )
 
-    # Send the GET request
-    response = r.get(url)
+    # Send the GET request through the pooled Mapbox session
+    response = http_client.get("mapbox", url)
 
-    # Check the response status code
-    if response.status_code == 200:
-        # Process the response data
-        image = Image.open(io.BytesIO(response.content))
-    else:
-        logger.error("API call failed with status code:", response)
-        image = None
-    return image
+    # Failed requests raise, so the tile is left pending instead of saved with no green density
+    if response.status_code != 200:
+        raise r.exceptions.HTTPError(
+            f"Mapbox satellite image failed with status code {response.status_code}",
+            response=response,
+        )
+    return Image.open(io.BytesIO(response.content))
 
 def get_n_bus_lines(min_lat, max_lat, min_lon, max_lon):
-    # Import the overpy module
-    
-    api = overpy.Overpass()
-
     bbox = [*map(lambda x: str(x), [min_lat, min_lon, max_lat, max_lon])]
     query = f'relation["route"="bus"]({",".join(bbox)});out;'
 
-    # Execute the query
-    result = api.query(query)
+    # Execute the query through the pooled Overpass session
+    result = http_client.overpass_query(query)
 
     # Output the number of bus stops
     return len(result.relations)
 
 def is_next_to_park(lat, lon):
-    api = overpy.Overpass()
-
     query = f'nwr["leisure"="park"](around:1000, {lat}, {lon});out;'
 
-    # Execute the query
-    result = api.query(query)
+    # Execute the query through the pooled Overpass session
+    result = http_client.overpass_query(query)
 
     next_to_park = False
     for way in result.ways:
@@ -300,3 +308,155 @@ def get_search_parameters():
     unit_subtype = get_unit_subtype(sys.argv[3])
 
     return sys.argv[1], sys.argv[2], unit_type, unit_type_v3, unit_subtype, sys.argv[4], neighborhoods
+
+
+def load_manifest(path):
+    """
+    Load a run manifest listing the markets scraped on a run
+    Args:
+        path (str): Path to a JSON file with a "markets" list, each market with
+            state, city, unit_type, business_type and optionally neighborhoods
+    Returns:
+        Dictionary with the manifest
+    """
+    with open(path, encoding="utf-8") as manifest_file:
+        manifest = json.load(manifest_file)
+    assert manifest.get("markets"), f"No markets found on manifest {path}"
+    return manifest
+
+
+def get_market_parameters(market):
+    """
+    Get the search parameters of a market from a run manifest
+    Args:
+        market (dict): Market with state, city, unit_type, business_type and
+            optionally neighborhoods, if not given all neighborhoods of the city are searched
+    Returns:
+        Same parameters as get_search_parameters
+    """
+    assert market["unit_type"] in ["APARTMENT", "HOME"], \
+        "Unit type must be APARTMENT or HOME"
+    assert market["business_type"] in ["SALE", "RENTAL"], \
+        "Business type must be either SALE or RENTAL"
+    neighborhoods = market.get("neighborhoods") or get_neighborhoods_from_city_and_state(
+        market["state"], market["city"]
+    )
+    return (
+        market["state"],
+        market["city"],
+        get_unit_type(market["unit_type"]),
+        get_unit_type_v3(market["unit_type"]),
+        get_unit_subtype(market["unit_type"]),
+        market["business_type"],
+        neighborhoods,
+    )
+
+
+class ZipCodeResolver:
+    """
+    Run-wide resolver of street complements by zip code. Unknown zip codes of a
+    page are downloaded concurrently over the pooled client, and empty or failed
+    lookups are remembered so they aren't retried for every listing
+    """
+
+    invalid_zip_codes = ("", "00000000")
+    # Result of lookups skipped while the provider's circuit is open
+    PENDING = object()
+
+    def __init__(self, max_workers: int = 8):
+        self.max_workers = max_workers
+        # Complements found, including empty ones
+        self._complements = {}
+        # Zip codes whose lookup failed
+        self._failed = set()
+        # Zip codes already handed to a page to be saved
+        self._claimed = set()
+        self._lock = threading.Lock()
+
+    def is_known(self, zip_code) -> bool:
+        """Check if a zip code was already resolved or failed"""
+        return zip_code in self._complements or zip_code in self._failed
+
+    def prefetch(self, zip_codes):
+        """
+        Resolve unknown zip codes concurrently
+        Args:
+            zip_codes (iterable): Zip codes that will be needed
+        """
+        with self._lock:
+            missing_zip_codes = sorted(
+                {
+                    zip_code
+                    for zip_code in zip_codes
+                    if zip_code not in self.invalid_zip_codes and not self.is_known(zip_code)
+                }
+            )
+        if not missing_zip_codes:
+            return
+        logger.info(f"\tResolving {len(missing_zip_codes)} zip codes")
+        with ThreadPoolExecutor(
+            max_workers=min(self.max_workers, len(missing_zip_codes))
+        ) as executor:
+            complements = executor.map(self._lookup, missing_zip_codes)
+            for zip_code, complement in zip(missing_zip_codes, complements):
+                with self._lock:
+                    # Not remembered, so it is looked up again once the circuit closes
+                    if complement is self.PENDING:
+                        continue
+                    if complement is None:
+                        self._failed.add(zip_code)
+                    else:
+                        self._complements[zip_code] = complement
+
+    def resolve(self, zip_code):
+        """
+        Get the street complement of a zip code
+        Returns:
+            Street complement, or None if the lookup failed
+        """
+        if not self.is_known(zip_code):
+            self.prefetch([zip_code])
+        return self._complements.get(zip_code)
+
+    def claim(self, zip_code) -> bool:
+        """
+        Check if a downloaded zip code still has to be saved, so only the first
+        page that uses it adds it to the database
+        """
+        with self._lock:
+            if zip_code in self._claimed:
+                return False
+            self._claimed.add(zip_code)
+            return True
+
+    def _lookup(self, zip_code):
+        """
+        Download a street complement, returning None on failure, or PENDING if the
+        provider's circuit is open
+        """
+        try:
+            return self.download_street_complement(zip_code)
+        except CircuitOpenError:
+            return self.PENDING
+        except (r.exceptions.RequestException, ValueError, AttributeError) as error:
+            logger.info(f"Failed resolving zip code {zip_code}: {error}")
+            return None
+
+    def download_street_complement(self, zip_code):
+        """
+        Get street complement from BrasilAberto.com API
+        Args:
+            zip_code (str): Zip code for location
+        """
+        # Connection errors and throttling are retried by the client
+        response = http_client.get(
+            "brasil_aberto",
+            f"/v1/zipcode/{zip_code}.json",
+            headers={"Bearer": os.environ["BRASIL_ABERTO_API_KEY_FREE"]},
+        )
+        zip_data = response.json()
+        street_complement = zip_data.get("result").get("complement", "")
+        return street_complement or ""
+
+
+zip_code_resolver = ZipCodeResolver()
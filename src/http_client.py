@@ -0,0 +1,332 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Optional
+
+import cloudscraper
+import overpy
+import requests as r
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from src.resilience import CircuitBreaker
+from src.throttle import AdaptiveRateLimiter
+from src.tracing import tracer
+
+# Configure logging
+logging.basicConfig(
+    format="%(asctime)s %(name)-12s %(levelname)-8s %(message)s", level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class Provider:
+    """Connection settings of an external HTTP provider"""
+
+    name: str
+    base_url: str
+    # Keep-alive connections kept open to the provider's host
+    pool_size: int
+    # Connect and read timeouts, in seconds
+    timeout: tuple
+    # Retries of connection errors and retryable status codes
+    max_retries: int
+    # Initial, lowest and highest request rates, in requests per second
+    rate: float
+    min_rate: float
+    max_rate: float
+    # Latency, in seconds, above which the rate is reduced
+    target_latency: float
+    retry_methods: frozenset = frozenset({"GET"})
+    retry_statuses: frozenset = frozenset({429, 500, 502, 503, 504})
+    # Failed requests in a row that open the provider's circuit, None to never open it
+    failure_threshold: Optional[int] = 5
+    # Seconds the circuit stays open before a trial request
+    reset_timeout: float = 60
+    # Whether each concurrent request gets a session of its own, for sessions
+    # that aren't thread-safe
+    exclusive_sessions: bool = False
+
+
+PROVIDERS = {
+    provider.name: provider
+    for provider in [
+        Provider(
+            name="glue_api",
+            base_url=os.getenv("GLUE_API_URL", "https://glue-api.zapimoveis.com.br"),
+            pool_size=8,
+            timeout=(10, 30),
+            # Pages are retried by ZapPage.get_page, which also retries invalid JSON
+            max_retries=0,
+            rate=2,
+            min_rate=0.2,
+            max_rate=10,
+            target_latency=10,
+            # Failing proxies are quarantined by the proxy pool instead
+            failure_threshold=None,
+            # Scraper sessions keep challenge state, so parallel lanes don't share one
+            exclusive_sessions=True,
+        ),
+        Provider(
+            name="mapbox",
+            base_url=os.getenv("MAPBOX_API_URL", "https://api.mapbox.com"),
+            pool_size=8,
+            timeout=(5, 30),
+            max_retries=3,
+            rate=5,
+            min_rate=0.5,
+            max_rate=20,
+            target_latency=10,
+        ),
+        Provider(
+            name="overpass",
+            base_url=os.getenv("OVERPASS_API_URL", "https://overpass-api.de/api"),
+            pool_size=4,
+            timeout=(10, 120),
+            max_retries=3,
+            # Public Overpass instances allow very few concurrent queries
+            rate=1,
+            min_rate=0.1,
+            max_rate=4,
+            target_latency=30,
+            # Overpass queries are sent with POST, but don't change anything
+            retry_methods=frozenset({"GET", "POST"}),
+        ),
+        Provider(
+            name="brasil_aberto",
+            base_url=os.getenv("BRASIL_ABERTO_API_URL", "https://api.brasilaberto.com"),
+            pool_size=8,
+            timeout=(5, 15),
+            max_retries=3,
+            rate=5,
+            min_rate=0.5,
+            max_rate=20,
+            target_latency=5,
+        ),
+    ]
+}
+
+
+class HttpClient:
+    """
+    Provider-aware HTTP client, keeping one pooled keep-alive session and one
+    adaptive rate limiter per external provider, shared by every request of the process.
+    Providers with exclusive sessions keep a pool of sessions instead, each used
+    by one request at a time
+    """
+
+    def __init__(self, providers: dict = PROVIDERS):
+        self.providers = providers
+        self._sessions = {}
+        self._idle_sessions = {}
+        self.rate_limiters = {
+            name: AdaptiveRateLimiter(
+                name,
+                rate=provider.rate,
+                min_rate=provider.min_rate,
+                max_rate=provider.max_rate,
+                target_latency=provider.target_latency,
+            )
+            for name, provider in providers.items()
+        }
+        self.circuit_breakers = {
+            name: CircuitBreaker(
+                name,
+                failure_threshold=provider.failure_threshold,
+                reset_timeout=provider.reset_timeout,
+            )
+            for name, provider in providers.items()
+            if provider.failure_threshold is not None
+        }
+        self._lock = threading.Lock()
+        # Only used to parse responses, queries are sent through the pooled session
+        self._overpass = overpy.Overpass()
+
+    def create_session(self, provider: Provider) -> r.Session:
+        """Create a session with a connection pool and retry policy for a provider"""
+        # Only connection errors are retried by the adapter, retryable status codes
+        # are retried by request, so the rate limiter sees every attempt
+        retry = Retry(
+            total=provider.max_retries,
+            backoff_factor=0.5,
+            status=0,
+            allowed_methods=provider.retry_methods,
+        )
+        if provider.name == "glue_api":
+            # glue-api is behind Cloudflare, so it needs a scraper session, whose
+            # browser headers, cipher suite and ECDH curve are kept
+            session = cloudscraper.create_scraper(
+                browser={"browser": "chrome", "platform": "windows", "mobile": False},
+                sess=r.Session(),
+            )
+            session.mount(
+                "https://",
+                cloudscraper.CipherSuiteAdapter(
+                    cipherSuite=session.cipherSuite,
+                    ecdhCurve=session.ecdhCurve,
+                    server_hostname=session.server_hostname,
+                    source_address=session.source_address,
+                    ssl_context=session.ssl_context,
+                    pool_connections=1,
+                    pool_maxsize=provider.pool_size,
+                    max_retries=retry,
+                ),
+            )
+            session.mount(
+                "http://",
+                HTTPAdapter(pool_connections=1, pool_maxsize=provider.pool_size, max_retries=retry),
+            )
+            return session
+        session = r.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=provider.pool_size, max_retries=retry
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.headers["Accept-Encoding"] = "gzip, deflate"
+        return session
+
+    def get_session(self, provider_name: str) -> r.Session:
+        """Get the shared session of a provider, creating it on first use"""
+        with self._lock:
+            if provider_name not in self._sessions:
+                self._sessions[provider_name] = self.create_session(
+                    self.providers[provider_name]
+                )
+            return self._sessions[provider_name]
+
+    @contextmanager
+    def checkout_session(self, provider_name: str):
+        """
+        Use a session of a provider for a request. Providers with exclusive
+        sessions lend an idle session, or a new one, returned once the request ends
+        """
+        provider = self.providers[provider_name]
+        if not provider.exclusive_sessions:
+            yield self.get_session(provider_name)
+            return
+        with self._lock:
+            idle_sessions = self._idle_sessions.setdefault(provider_name, [])
+            session = idle_sessions.pop() if idle_sessions else None
+        if session is None:
+            session = self.create_session(provider)
+        try:
+            yield session
+        finally:
+            with self._lock:
+                self._idle_sessions.setdefault(provider_name, []).append(session)
+
+    def request(self, provider_name: str, method: str, path: str, **kwargs) -> r.Response:
+        """
+        Send a request to a provider
+        Args:
+            provider_name (str): Name of the provider on PROVIDERS
+            method (str): HTTP method
+            path (str): Path appended to the provider's base URL
+            kwargs: Arguments passed to requests, like params, headers or proxies
+        Raises:
+            CircuitOpenError: If the provider's circuit is open
+        """
+        # The query string is left out of the span, as it may carry credentials
+        # like Mapbox's access_token, and spans are written to trace exports
+        with tracer.span(
+            f"http.{provider_name}", method=method, path=path.split("?", 1)[0]
+        ) as span:
+            circuit_breaker = self.circuit_breakers.get(provider_name)
+            if circuit_breaker is None:
+                response = self._send(provider_name, method, path, **kwargs)
+                span.attributes["status"] = response.status_code
+                return response
+            circuit_breaker.before_request()
+            try:
+                response = self._send(provider_name, method, path, **kwargs)
+            except Exception:
+                circuit_breaker.record_failure()
+                raise
+            span.attributes["status"] = response.status_code
+            if response.status_code in self.providers[provider_name].retry_statuses:
+                circuit_breaker.record_failure()
+            else:
+                circuit_breaker.record_success()
+            return response
+
+    def _send(self, provider_name: str, method: str, path: str, **kwargs) -> r.Response:
+        """Send a request to a provider, retrying retryable status codes"""
+        provider = self.providers[provider_name]
+        rate_limiter = self.rate_limiters[provider_name]
+        kwargs.setdefault("timeout", provider.timeout)
+        max_attempts = provider.max_retries + 1 if method in provider.retry_methods else 1
+        for attempt in range(1, max_attempts + 1):
+            rate_limiter.acquire()
+            start = time.monotonic()
+            try:
+                with self.checkout_session(provider_name) as session:
+                    response = session.request(method, f"{provider.base_url}{path}", **kwargs)
+            except r.exceptions.RequestException:
+                rate_limiter.record_error()
+                raise
+            rate_limiter.record(response.status_code, time.monotonic() - start)
+            if response.status_code not in provider.retry_statuses or attempt == max_attempts:
+                # The last response is returned, so callers can handle the status code
+                return response
+            time.sleep(self.get_retry_delay(response, attempt))
+
+    @staticmethod
+    def get_retry_delay(response: r.Response, attempt: int) -> float:
+        """Get seconds to wait before retrying, following Retry-After when sent"""
+        retry_after = response.headers.get("Retry-After", "")
+        if retry_after.isdigit():
+            return min(float(retry_after), 60.0)
+        return 0.5 * 2 ** (attempt - 1)
+
+    def get(self, provider_name: str, path: str, **kwargs) -> r.Response:
+        """Send a GET request to a provider"""
+        return self.request(provider_name, "GET", path, **kwargs)
+
+    def post(self, provider_name: str, path: str, **kwargs) -> r.Response:
+        """Send a POST request to a provider"""
+        return self.request(provider_name, "POST", path, **kwargs)
+
+    def overpass_query(self, query: str) -> overpy.Result:
+        """
+        Run an Overpass QL query through the pooled session
+        Args:
+            query (str): Query without output format, JSON is requested
+        """
+        response = self.post("overpass", "/interpreter", data={"data": f"[out:json];{query}"})
+        response.raise_for_status()
+        return self._overpass.parse_json(response.content)
+
+    def get_metrics(self) -> dict:
+        """Get the current rate, throttling counters and circuit state of every provider"""
+        metrics = {
+            name: rate_limiter.get_metrics()
+            for name, rate_limiter in self.rate_limiters.items()
+        }
+        for name, circuit_breaker in self.circuit_breakers.items():
+            metrics[name]["circuit"] = circuit_breaker.get_metrics()
+        return metrics
+
+    def log_metrics(self):
+        """Log the rate and throttling counters of providers that were used"""
+        for name, metrics in self.get_metrics().items():
+            if metrics["requests"]:
+                logger.info(f"{name} requests: {metrics}")
+
+    def close(self):
+        """Close every provider session"""
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            for idle_sessions in self._idle_sessions.values():
+                for session in idle_sessions:
+                    session.close()
+            self._sessions = {}
+            self._idle_sessions = {}
+
+
+http_client = HttpClient()
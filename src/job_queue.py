@@ -0,0 +1,339 @@
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+import uuid
+from typing import Optional
+
+from sqlalchemy import text
+
+from src.database import db_manager
+
+# Configure logging
+logging.basicConfig(
+    format="%(asctime)s %(name)-12s %(levelname)-8s %(message)s", level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+# Columns identifying what a job scrapes
+JOB_COLUMNS = [
+    "state",
+    "city",
+    "neighborhood",
+    "unit_type",
+    "business_type",
+    "min_price",
+    "max_price",
+]
+
+
+class JobQueue:
+    """
+    Queue of scraping jobs on Postgres, shared by any number of workers. Jobs are
+    claimed with leases that workers extend with heartbeats, and jobs whose lease
+    expired, because their worker died, are claimed again until max attempts,
+    and failed once their last attempt expires
+    """
+
+    def __init__(self, db_manager, lease_seconds: int = 600):
+        self.db_manager = db_manager
+        self.lease_seconds = lease_seconds
+
+    def enqueue(self, run_id: str, jobs: list, max_attempts: int = 3) -> int:
+        """
+        Add jobs to a run, ignoring the ones the run already has
+        Args:
+            run_id (str): Run the jobs belong to
+            jobs (list): Dictionaries with the JOB_COLUMNS of each job
+            max_attempts (int): Times a job is tried before failing for good
+        Returns:
+            Number of jobs added
+        """
+        if not jobs:
+            return 0
+        with self.db_manager.get_transaction() as conn:
+            result = conn.execute(
+                text(
+                    f"""
+                    INSERT INTO etl_jobs (run_id, max_attempts, {', '.join(JOB_COLUMNS)})
+                    VALUES (:run_id, :max_attempts, {', '.join(f':{column}' for column in JOB_COLUMNS)})
+                    ON CONFLICT DO NOTHING
+                    """
+                ),
+                [
+                    {"run_id": run_id, "max_attempts": max_attempts, **{column: job[column] for column in JOB_COLUMNS}}
+                    for job in jobs
+                ],
+            )
+        logger.info(f"Enqueued {result.rowcount} jobs on run {run_id}")
+        return result.rowcount
+
+    @staticmethod
+    def fail_expired(conn, run_id: Optional[str] = None) -> int:
+        """
+        Fail for good the jobs whose worker died on their last attempt, as their
+        lease expired and they can't be claimed again
+        Args:
+            conn: Connection in a transaction
+            run_id (str): If given, only jobs of this run are failed
+        Returns:
+            Number of jobs failed
+        """
+        run_condition = "AND run_id = :run_id" if run_id is not None else ""
+        result = conn.execute(
+            text(
+                f"""
+                UPDATE etl_jobs
+                SET
+                    status = 'failed',
+                    finished_at = now(),
+                    last_error = 'Lease expired on the last attempt',
+                    lease_owner = NULL,
+                    lease_expires_at = NULL
+                WHERE status = 'running'
+                    AND lease_expires_at < now()
+                    AND attempts >= max_attempts
+                    {run_condition}
+                """
+            ),
+            {"run_id": run_id},
+        )
+        if result.rowcount:
+            logger.warning(f"Failed {result.rowcount} jobs whose lease expired on their last attempt")
+        return result.rowcount
+
+    def claim(self, worker_id: str, run_id: Optional[str] = None) -> Optional[dict]:
+        """
+        Lease the oldest available job, skipping jobs locked by other workers
+        Args:
+            worker_id (str): Worker claiming the job
+            run_id (str): If given, only jobs of this run are claimed
+        Returns:
+            Job as a dictionary, or None if there are no jobs available
+        """
+        run_condition = "AND run_id = :run_id" if run_id is not None else ""
+        with self.db_manager.get_transaction() as conn:
+            self.fail_expired(conn, run_id)
+            job = conn.execute(
+                text(
+                    f"""
+                    UPDATE etl_jobs
+                    SET
+                        status = 'running',
+                        attempts = attempts + 1,
+                        lease_owner = :worker_id,
+                        lease_expires_at = now() + make_interval(secs => :lease_seconds),
+                        heartbeat_at = now(),
+                        started_at = now()
+                    WHERE id = (
+                        SELECT id
+                        FROM etl_jobs
+                        WHERE
+                            (
+                                status = 'pending'
+                                OR (status = 'running' AND lease_expires_at < now())
+                            )
+                            AND attempts < max_attempts
+                            {run_condition}
+                        ORDER BY id
+                        LIMIT 1
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING *
+                    """
+                ),
+                {"worker_id": worker_id, "lease_seconds": self.lease_seconds, "run_id": run_id},
+            ).mappings().first()
+        return dict(job) if job is not None else None
+
+    def heartbeat(self, job_id: int, worker_id: str) -> bool:
+        """
+        Extend the lease of a running job
+        Returns:
+            Whether the worker still holds the lease
+        """
+        with self.db_manager.get_transaction() as conn:
+            result = conn.execute(
+                text(
+                    """
+                    UPDATE etl_jobs
+                    SET
+                        lease_expires_at = now() + make_interval(secs => :lease_seconds),
+                        heartbeat_at = now()
+                    WHERE id = :job_id AND lease_owner = :worker_id AND status = 'running'
+                    """
+                ),
+                {"job_id": job_id, "worker_id": worker_id, "lease_seconds": self.lease_seconds},
+            )
+        return result.rowcount == 1
+
+    def complete(self, job_id: int, worker_id: str, result: dict) -> bool:
+        """
+        Mark a job as done with a summary of its results
+        Returns:
+            Whether the worker still held the lease
+        """
+        with self.db_manager.get_transaction() as conn:
+            updated = conn.execute(
+                text(
+                    """
+                    UPDATE etl_jobs
+                    SET status = 'done', finished_at = now(), result = CAST(:result AS jsonb),
+                        lease_expires_at = NULL
+                    WHERE id = :job_id AND lease_owner = :worker_id AND status = 'running'
+                    """
+                ),
+                {"job_id": job_id, "worker_id": worker_id, "result": json.dumps(result, default=str)},
+            )
+        return updated.rowcount == 1
+
+    def fail(self, job_id: int, worker_id: str, error: str):
+        """Release a failed job to be retried, or fail it for good after max attempts"""
+        with self.db_manager.get_transaction() as conn:
+            conn.execute(
+                text(
+                    """
+                    UPDATE etl_jobs
+                    SET
+                        status = CASE WHEN attempts < max_attempts THEN 'pending' ELSE 'failed' END,
+                        finished_at = now(),
+                        last_error = :error,
+                        lease_owner = NULL,
+                        lease_expires_at = NULL
+                    WHERE id = :job_id AND lease_owner = :worker_id AND status = 'running'
+                    """
+                ),
+                {"job_id": job_id, "worker_id": worker_id, "error": error[:2000]},
+            )
+
+    def is_market_done(self, run_id: str, city: str, business_type: str, unit_type: str) -> bool:
+        """Check if every job of a market on a run finished, successfully or not"""
+        with self.db_manager.get_transaction() as conn:
+            self.fail_expired(conn, run_id)
+            unfinished = conn.execute(
+                text(
+                    """
+                    SELECT count(*)
+                    FROM etl_jobs
+                    WHERE run_id = :run_id
+                        AND city = :city
+                        AND business_type = :business_type
+                        AND unit_type = :unit_type
+                        AND (
+                            status = 'running'
+                            OR (status = 'pending' AND attempts < max_attempts)
+                        )
+                    """
+                ),
+                {"run_id": run_id, "city": city, "business_type": business_type, "unit_type": unit_type},
+            ).scalar()
+        return unfinished == 0
+
+    def get_summary(self, run_id: str) -> dict:
+        """Get the number of jobs of a run by status, and the totals of their results"""
+        with self.db_manager.get_connection() as conn:
+            rows = conn.execute(
+                text(
+                    """
+                    SELECT
+                        status,
+                        count(*) AS jobs,
+                        sum((result ->> 'n_listings')::integer) AS listings,
+                        sum(extract(epoch FROM finished_at - started_at)) AS seconds
+                    FROM etl_jobs
+                    WHERE run_id = :run_id
+                    GROUP BY status
+                    """
+                ),
+                {"run_id": run_id},
+            ).mappings().all()
+        return {row["status"]: {key: row[key] for key in ["jobs", "listings", "seconds"]} for row in rows}
+
+
+class LeaseHeartbeat:
+    """Context manager extending the lease of a job on a background thread while it runs"""
+
+    def __init__(self, job_queue: JobQueue, job_id: int, worker_id: str):
+        self.job_queue = job_queue
+        self.job_id = job_id
+        self.worker_id = worker_id
+        # Heartbeats are sent well before the lease expires
+        self.interval = job_queue.lease_seconds / 3
+        self.lost_lease = False
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"heartbeat-{job_id}", daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        """Send heartbeats until stopped"""
+        while not self._stopped.wait(self.interval):
+            try:
+                if not self.job_queue.heartbeat(self.job_id, self.worker_id):
+                    logger.warning(f"Lost the lease of job {self.job_id}")
+                    self.lost_lease = True
+                    return
+            except Exception as error:
+                # A missed heartbeat is retried on the next interval
+                logger.warning(f"Failed heartbeat of job {self.job_id}: {error}")
+
+
+def get_worker_id() -> str:
+    """Get an id for this worker, unique across machines"""
+    return os.getenv("ETL_WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+
+
+def get_manifest_jobs(manifest: dict, min_price: int = 200000, max_price: int = 2000000) -> list:
+    """
+    Get one job per neighborhood of every market of a run manifest
+    Args:
+        manifest (dict): Run manifest, see extract.load_manifest
+        min_price (int): Min listing price for sales, divided by 100 for rentals
+        max_price (int): Max listing price for sales, divided by 100 for rentals
+    """
+    # Imported here, so workers don't need the app dependencies to claim jobs
+    from src import extract
+
+    jobs = []
+    for market in manifest["markets"]:
+        state, city, _, _, _, business_type, neighborhoods = extract.get_market_parameters(market)
+        divisor = 100 if business_type == "RENTAL" else 1
+        for neighborhood in neighborhoods:
+            jobs.append(
+                {
+                    "state": state,
+                    "city": city,
+                    "neighborhood": neighborhood,
+                    "unit_type": market["unit_type"],
+                    "business_type": business_type,
+                    "min_price": int(min_price / divisor),
+                    "max_price": int(max_price / divisor),
+                }
+            )
+    return jobs
+
+
+job_queue = JobQueue(db_manager, lease_seconds=int(os.getenv("ETL_JOB_LEASE_SECONDS", "600")))
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else ""
+    if command == "enqueue" and len(sys.argv) == 4:
+        from src import extract
+
+        job_queue.enqueue(sys.argv[3], get_manifest_jobs(extract.load_manifest(sys.argv[2])))
+    elif command == "summary" and len(sys.argv) == 3:
+        print(json.dumps(job_queue.get_summary(sys.argv[2]), indent=2, default=str))
+    else:
+        logger.error(
+            "Use enqueue MANIFEST RUN_ID to add the jobs of a manifest, or summary RUN_ID"
+        )
+        sys.exit(1)
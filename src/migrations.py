@@ -0,0 +1,698 @@
+import json
+import logging
+import sys
+
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+
+from src.database import db_manager, partition_manager
+
+# Configure logging
+logging.basicConfig(
+    format="%(asctime)s %(name)-12s %(levelname)-8s %(message)s", level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+# Key used to serialize concurrent migration runs
+MIGRATION_LOCK_KEY = 741852
+
+
+class ConcurrentIndex:
+    """
+    Index built with CREATE INDEX CONCURRENTLY, outside the migration transaction,
+    so writes to large tables aren't blocked while it is built
+    """
+
+    def __init__(self, name: str, table: str, definition: str, unique: bool = False, unless: str = None):
+        """
+        Args:
+            name (str): Name of the index
+            table (str): Table indexed
+            definition (str): Columns and options following the table name
+            unique (bool): Whether the index is unique
+            unless (str): Query returning a row when an equivalent index already exists
+        """
+        self.name = name
+        self.table = table
+        self.definition = definition
+        self.unique = unique
+        self.unless = unless
+
+    def get_statement(self, concurrently: bool = True) -> str:
+        unique = "UNIQUE " if self.unique else ""
+        concurrently = "CONCURRENTLY " if concurrently else ""
+        return (
+            f"CREATE {unique}INDEX {concurrently}IF NOT EXISTS {self.name} "
+            f"ON {self.table} {self.definition}"
+        )
+
+
+# Versioned schema changes, applied in order and recorded on schema_migrations.
+# New changes must be appended with the next version number, never edited in place
+MIGRATIONS = [
+    (
+        1,
+        "Change watermark on dim_zip_code for delta sync",
+        [
+            """
+            ALTER TABLE dim_zip_code
+            ADD COLUMN IF NOT EXISTS created_at timestamptz NOT NULL DEFAULT now()
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS dim_zip_code_created_at_idx
+            ON dim_zip_code (created_at)
+            """,
+        ],
+    ),
+    (
+        2,
+        "Unique listing_id on fact_listings for upserts",
+        [
+            # Keep the most recent row of each duplicated listing, so the unique index can be built
+            """
+            DELETE FROM fact_listings AS target
+            USING (
+                SELECT
+                    ctid,
+                    row_number() OVER (
+                        PARTITION BY listing_id ORDER BY updated_at DESC NULLS LAST, ctid DESC
+                    ) AS position
+                FROM fact_listings
+                WHERE listing_id IN (
+                    SELECT listing_id FROM fact_listings GROUP BY listing_id HAVING count(*) > 1
+                )
+            ) AS duplicates
+            WHERE target.ctid = duplicates.ctid AND duplicates.position > 1
+            """,
+            ConcurrentIndex(
+                "fact_listings_listing_id_key",
+                "fact_listings",
+                "(listing_id)",
+                unique=True,
+                unless="""
+                    SELECT 1
+                    FROM pg_index
+                    JOIN pg_attribute
+                        ON pg_attribute.attrelid = pg_index.indrelid
+                        AND pg_attribute.attnum = pg_index.indkey[0]
+                    WHERE pg_index.indrelid = 'fact_listings'::regclass
+                    AND pg_index.indisunique
+                    AND pg_index.indisvalid
+                    AND pg_index.indnkeyatts = 1
+                    AND pg_attribute.attname = 'listing_id'
+                    """,
+            ),
+        ],
+    ),
+    (
+        3,
+        "Market index on fact_listings for searches, cleaning and expiring listings",
+        [
+            ConcurrentIndex(
+                "fact_listings_market_idx",
+                "fact_listings",
+                """
+                (city, business_type, neighborhood, unit_type, price)
+                INCLUDE (total_area_m2, price_per_area, listing_id)
+                """,
+            ),
+        ],
+    ),
+    (
+        4,
+        "Partial index on fact_listings for listings shown on the app",
+        [
+            ConcurrentIndex(
+                "fact_listings_first_quartile_idx",
+                "fact_listings",
+                """
+                (city, business_type)
+                WHERE price_per_area_in_first_quartile
+                """,
+            ),
+        ],
+    ),
+    (
+        5,
+        "Corner indexes on analysis tables for bounding box fetches",
+        [
+            """
+            CREATE INDEX IF NOT EXISTS fact_image_analysis_corner_idx
+            ON fact_image_analysis (min_lat, min_lon)
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS fact_traffic_analysis_corner_idx
+            ON fact_traffic_analysis (min_lat, min_lon)
+            """,
+        ],
+    ),
+    (
+        6,
+        "Flags derived from descriptions on fact_listings",
+        [
+            """
+            ALTER TABLE fact_listings
+            ADD COLUMN IF NOT EXISTS is_remodeled boolean,
+            ADD COLUMN IF NOT EXISTS is_furnished boolean,
+            ADD COLUMN IF NOT EXISTS has_sea_view boolean,
+            ADD COLUMN IF NOT EXISTS is_new_building boolean,
+            ADD COLUMN IF NOT EXISTS has_balcony boolean,
+            ADD COLUMN IF NOT EXISTS has_pool boolean
+            """,
+        ],
+    ),
+    (
+        7,
+        "Scrape history of neighborhoods for staleness-aware scheduling",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS etl_neighborhood_history (
+                id bigserial PRIMARY KEY,
+                city text NOT NULL,
+                business_type text NOT NULL,
+                unit_type text NOT NULL,
+                neighborhood text NOT NULL,
+                scraped_at timestamptz NOT NULL DEFAULT now(),
+                duration_seconds double precision NOT NULL,
+                n_pages integer NOT NULL,
+                n_listings integer NOT NULL,
+                n_changed integer NOT NULL,
+                completed boolean NOT NULL
+            )
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS etl_neighborhood_history_market_idx
+            ON etl_neighborhood_history (city, business_type, unit_type, neighborhood, scraped_at DESC)
+            """,
+        ],
+    ),
+    (
+        8,
+        "Job queue for scraping across workers",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS etl_jobs (
+                id bigserial PRIMARY KEY,
+                run_id text NOT NULL,
+                state text NOT NULL,
+                city text NOT NULL,
+                neighborhood text NOT NULL,
+                unit_type text NOT NULL,
+                business_type text NOT NULL,
+                min_price integer NOT NULL,
+                max_price integer NOT NULL,
+                status text NOT NULL DEFAULT 'pending',
+                attempts integer NOT NULL DEFAULT 0,
+                max_attempts integer NOT NULL DEFAULT 3,
+                lease_owner text,
+                lease_expires_at timestamptz,
+                heartbeat_at timestamptz,
+                created_at timestamptz NOT NULL DEFAULT now(),
+                started_at timestamptz,
+                finished_at timestamptz,
+                result jsonb,
+                last_error text,
+                UNIQUE (run_id, city, neighborhood, unit_type, business_type, min_price, max_price)
+            )
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS etl_jobs_claim_idx
+            ON etl_jobs (status, id)
+            WHERE status IN ('pending', 'running')
+            """,
+        ],
+    ),
+    (
+        9,
+        "Checkpoints to resume interrupted runs",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS etl_run_checkpoints (
+                run_id text NOT NULL,
+                city text NOT NULL,
+                business_type text NOT NULL,
+                unit_type text NOT NULL,
+                neighborhood text NOT NULL,
+                status text NOT NULL,
+                completed boolean NOT NULL DEFAULT false,
+                loaded_columns text[] NOT NULL DEFAULT '{}',
+                updated_at timestamptz NOT NULL DEFAULT now(),
+                PRIMARY KEY (run_id, city, business_type, unit_type, neighborhood)
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS etl_run_pages (
+                run_id text NOT NULL,
+                city text NOT NULL,
+                business_type text NOT NULL,
+                unit_type text NOT NULL,
+                neighborhood text NOT NULL,
+                price_band text NOT NULL DEFAULT '',
+                page_number integer NOT NULL,
+                page_data jsonb NOT NULL,
+                fetched_at timestamptz NOT NULL DEFAULT now(),
+                PRIMARY KEY (run_id, city, business_type, unit_type, neighborhood, price_band, page_number)
+            )
+            """,
+        ],
+    ),
+    (
+        10,
+        "Neighborhood watermarks for delta runs and fully scraped flag on run checkpoints",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS etl_neighborhood_watermarks (
+                city text NOT NULL,
+                business_type text NOT NULL,
+                unit_type text NOT NULL,
+                neighborhood text NOT NULL,
+                watermark timestamptz NOT NULL,
+                full_sweep_at timestamptz,
+                updated_at timestamptz NOT NULL DEFAULT now(),
+                PRIMARY KEY (city, business_type, unit_type, neighborhood)
+            )
+            """,
+            """
+            ALTER TABLE etl_run_checkpoints
+            ADD COLUMN IF NOT EXISTS scraped_all_pages boolean NOT NULL DEFAULT false
+            """,
+        ],
+    ),
+    (
+        11,
+        "Created at watermarks on analysis tables for delta sync",
+        [
+            """
+            ALTER TABLE fact_image_analysis
+            ADD COLUMN IF NOT EXISTS created_at timestamptz NOT NULL DEFAULT now()
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS fact_image_analysis_created_at_idx
+            ON fact_image_analysis (created_at)
+            """,
+            """
+            ALTER TABLE fact_traffic_analysis
+            ADD COLUMN IF NOT EXISTS created_at timestamptz NOT NULL DEFAULT now()
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS fact_traffic_analysis_created_at_idx
+            ON fact_traffic_analysis (created_at)
+            """,
+        ],
+    ),
+    (
+        12,
+        "Delta flag on neighborhood history",
+        [
+            """
+            ALTER TABLE etl_neighborhood_history
+            ADD COLUMN IF NOT EXISTS delta boolean NOT NULL DEFAULT false
+            """,
+        ],
+    ),
+    (
+        13,
+        "Enrichment attempt time on listings, so backfills rotate through pending ones",
+        [
+            """
+            ALTER TABLE fact_listings
+            ADD COLUMN IF NOT EXISTS enrichment_attempted_at timestamptz
+            """,
+            ConcurrentIndex(
+                "fact_listings_pending_enrichment_idx",
+                "fact_listings",
+                """
+                (city, enrichment_attempted_at NULLS FIRST)
+                WHERE green_density IS NULL
+                    OR is_next_to_park IS NULL
+                    OR n_nearby_bus_lanes IS NULL
+                """,
+            ),
+        ],
+    ),
+]
+
+# Statements on the hot paths of the ETL and the app, with the tables they should
+# reach through an index
+HOT_STATEMENTS = {
+    "get_existing_ids": """
+        SELECT listing_id
+        FROM fact_listings
+        WHERE city = :city
+            AND neighborhood = :neighborhood
+            AND business_type = :business_type
+            AND total_area_m2 >= :min_area
+            AND price BETWEEN :min_price AND :max_price
+        """,
+    "remove_outliers": """
+        SELECT price_per_area
+        FROM fact_listings
+        WHERE city = :city
+            AND neighborhood = :neighborhood
+            AND business_type = :business_type
+            AND unit_type = :unit_type
+            AND price >= :min_price
+            AND price <= :max_price
+            AND total_area_m2 >= :min_area
+        """,
+    "calculate_price_per_area_first_quartile": """
+        SELECT price_per_area
+        FROM fact_listings
+        WHERE city = :city
+            AND neighborhood = :neighborhood
+            AND business_type = :business_type
+            AND unit_type = :unit_type
+        """,
+    "expire_old_listings": """
+        SELECT listing_id
+        FROM fact_listings
+        WHERE city = :city
+            AND business_type = :business_type
+            AND unit_type = ANY(ARRAY[:unit_type])
+            AND neighborhood = ANY(ARRAY[:neighborhood])
+        """,
+    "extract.get_listings": """
+        SELECT *
+        FROM fact_listings
+        WHERE price_per_area_in_first_quartile = True
+            AND business_type = :business_type
+            AND city = :city
+        """,
+    # Planned without running it, as EXPLAIN doesn't execute the update
+    "transform.update_derived_columns": """
+        WITH tiles AS (
+            SELECT
+                listing_id,
+                business_type,
+                is_next_to_park,
+                NTILE(3) OVER (ORDER BY green_density) AS green_density_tile,
+                NTILE(4) OVER (ORDER BY n_nearby_bus_lanes) AS n_nearby_bus_lanes_tile
+            FROM fact_listings
+            WHERE city = :city
+        ),
+        derived AS (
+            SELECT
+                listing_id,
+                business_type,
+                CASE
+                    WHEN green_density_tile = 3 THEN 'Bastante Verde'
+                    WHEN green_density_tile = 2 THEN 'Moderadamente Verde'
+                    WHEN green_density_tile = 1 and is_next_to_park is False THEN 'Pouco Verde'
+                    WHEN is_next_to_park is True THEN 'Moderadamente Verde'
+                END AS green_density_grouped,
+                CASE n_nearby_bus_lanes_tile
+                    WHEN 1 THEN 'Muito Calmo'
+                    WHEN 2 THEN 'Calmo'
+                    WHEN 3 THEN 'Movimentado'
+                    WHEN 4 THEN 'Agitado'
+                END AS n_nearby_bus_lanes_grouped
+            FROM tiles
+        )
+        UPDATE fact_listings
+        SET
+            green_density_grouped = derived.green_density_grouped,
+            n_nearby_bus_lanes_grouped = derived.n_nearby_bus_lanes_grouped
+        FROM derived
+        WHERE fact_listings.listing_id = derived.listing_id
+            AND fact_listings.business_type = derived.business_type
+            AND city = :city
+            AND fact_listings.business_type = :business_type
+            AND (
+                fact_listings.green_density_grouped,
+                fact_listings.n_nearby_bus_lanes_grouped
+            ) IS DISTINCT FROM (
+                derived.green_density_grouped,
+                derived.n_nearby_bus_lanes_grouped
+            )
+        """,
+    "bulk_get_analysis_data": """
+        SELECT min_lat, max_lat, min_lon, max_lon, green_density, is_next_to_park
+        FROM fact_image_analysis
+        WHERE min_lat BETWEEN :min_lat - 0.01 AND :min_lat + 0.05
+            AND min_lon BETWEEN :min_lon - 0.01 AND :min_lon + 0.05
+        """,
+}
+
+
+def ensure_migrations_table(conn):
+    """Create the table that records applied migrations"""
+    conn.execute(
+        text(
+            """
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version integer PRIMARY KEY,
+                description text NOT NULL,
+                applied_at timestamptz NOT NULL DEFAULT now()
+            )
+            """
+        )
+    )
+
+
+def get_applied_versions(conn):
+    """Get the versions of migrations already applied"""
+    result = conn.execute(text("SELECT version FROM schema_migrations"))
+    return {row[0] for row in result}
+
+
+def create_concurrent_index(index: ConcurrentIndex):
+    """
+    Build an index concurrently, on an autocommit connection. Partitioned tables
+    don't support concurrent builds, so theirs are built in a transaction
+    """
+    if partition_manager.is_partitioned(index.table):
+        with db_manager.get_transaction() as conn:
+            if index.unless is None or conn.execute(text(index.unless)).first() is None:
+                conn.execute(text(index.get_statement(concurrently=False)))
+        return
+    with db_manager.get_connection() as conn:
+        conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+        if index.unless is not None and conn.execute(text(index.unless)).first() is not None:
+            return
+        # A concurrent build that failed leaves an invalid index behind, which
+        # IF NOT EXISTS would keep. Builds still running elsewhere are left alone
+        leftover = conn.execute(
+            text(
+                """
+                SELECT 1 FROM pg_index
+                WHERE indexrelid = to_regclass(:name)
+                AND NOT indisvalid
+                AND NOT EXISTS (
+                    SELECT 1 FROM pg_stat_progress_create_index
+                    WHERE index_relid = to_regclass(:name)
+                )
+                """
+            ),
+            {"name": index.name},
+        ).first()
+        if leftover is not None:
+            logger.info(f"Dropping invalid index {index.name} left by a failed build")
+            conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {index.name}"))
+        try:
+            conn.execute(text(index.get_statement()))
+        except DBAPIError:
+            # Another process may have built the same index at the same time
+            valid = conn.execute(
+                text("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:name)"),
+                {"name": index.name},
+            ).scalar()
+            if not valid:
+                raise
+
+
+def migrate():
+    """
+    Apply pending migrations in order. Statements of a migration run in their own
+    transaction, then its indexes on large tables are built concurrently, outside
+    of it, and the migration is recorded once they are built
+    Returns:
+        List with the versions applied
+    """
+    with db_manager.get_transaction() as conn:
+        ensure_migrations_table(conn)
+    applied = []
+    for version, description, statements in MIGRATIONS:
+        with db_manager.get_transaction() as conn:
+            # Only one process applies the statements of a given migration
+            conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": MIGRATION_LOCK_KEY})
+            if version in get_applied_versions(conn):
+                continue
+            logger.info(f"Applying migration {version}: {description}")
+            for statement in statements:
+                if not isinstance(statement, ConcurrentIndex):
+                    conn.execute(text(statement))
+        # Concurrent builds can't hold the lock, they wait for open transactions
+        for statement in statements:
+            if isinstance(statement, ConcurrentIndex):
+                create_concurrent_index(statement)
+        with db_manager.get_transaction() as conn:
+            conn.execute(
+                text(
+                    """
+                    INSERT INTO schema_migrations (version, description)
+                    VALUES (:version, :description)
+                    ON CONFLICT (version) DO NOTHING
+                    """
+                ),
+                {"version": version, "description": description},
+            )
+        applied.append(version)
+    logger.info(f"Applied {len(applied)} migrations")
+    return applied
+
+
+def partition_fact_listings():
+    """
+    Convert fact_listings into a table list-partitioned by city and then by
+    business type, copying its rows in a single transaction. This rewrites the
+    whole table, so it is applied on demand instead of with the other migrations
+    """
+    if partition_manager.is_partitioned("fact_listings"):
+        logger.info("fact_listings is already partitioned")
+        return
+    try:
+        _partition_fact_listings()
+    finally:
+        # Read the partitioning status from the DB again, whether it succeeded or not
+        partition_manager.reset("fact_listings")
+    logger.info("Partitioned fact_listings by city and business type")
+
+
+def _partition_fact_listings():
+    """Rewrite fact_listings as a partitioned table in a single transaction"""
+    with db_manager.get_transaction() as conn:
+        conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": MIGRATION_LOCK_KEY})
+        conn.execute(text("ALTER TABLE fact_listings RENAME TO fact_listings_unpartitioned"))
+        conn.execute(
+            text(
+                """
+                CREATE TABLE fact_listings
+                (LIKE fact_listings_unpartitioned INCLUDING DEFAULTS)
+                PARTITION BY LIST (city)
+                """
+            )
+        )
+        conn.execute(text("CREATE TABLE fact_listings_default PARTITION OF fact_listings DEFAULT"))
+        # The new table isn't visible outside this transaction yet
+        partition_manager.set_partitioned("fact_listings", True)
+        markets = conn.execute(
+            text("SELECT DISTINCT city, business_type FROM fact_listings_unpartitioned")
+        ).all()
+        for city, business_type in markets:
+            # Rows without a market are kept on the default partitions
+            if city is None or business_type is None:
+                continue
+            partition_manager.ensure_partition(conn, city, business_type)
+        logger.info(f"Created partitions for {len(markets)} markets")
+        conn.execute(
+            text(
+                """
+                INSERT INTO fact_listings
+                SELECT * FROM fact_listings_unpartitioned
+                """
+            )
+        )
+        # Indexes are dropped with the old table, so their names can be reused
+        conn.execute(text("DROP TABLE fact_listings_unpartitioned"))
+        conn.execute(
+            text(
+                """
+                ALTER TABLE fact_listings
+                ADD CONSTRAINT fact_listings_market_key UNIQUE (listing_id, city, business_type)
+                """
+            )
+        )
+        for version, _, statements in MIGRATIONS:
+            # Listing ids alone can't be unique on a partitioned table
+            if version == 2:
+                continue
+            for statement in statements:
+                # Indexes of a partitioned table can't be built concurrently
+                if isinstance(statement, ConcurrentIndex):
+                    if statement.table == "fact_listings":
+                        conn.execute(text(statement.get_statement(concurrently=False)))
+                elif "fact_listings" in statement and "ALTER TABLE" not in statement:
+                    conn.execute(text(statement))
+
+
+def find_sequential_scans(plan):
+    """
+    Walk an EXPLAIN plan and collect the relations read with sequential scans
+    Args:
+        plan (dict): Plan node from EXPLAIN (FORMAT JSON)
+    """
+    relations = []
+    if plan.get("Node Type") == "Seq Scan":
+        relations.append(plan.get("Relation Name"))
+    for child in plan.get("Plans", []):
+        relations.extend(find_sequential_scans(child))
+    return relations
+
+
+def get_sample_parameters(conn):
+    """Get parameters of an existing market, so hot statements are planned with real values"""
+    sample = conn.execute(
+        text(
+            """
+            SELECT city, neighborhood, business_type, unit_type, latitude, longitude
+            FROM fact_listings
+            WHERE latitude IS NOT NULL
+            LIMIT 1
+            """
+        )
+    ).mappings().first()
+    if sample is None:
+        return None
+    return {
+        "city": sample["city"],
+        "neighborhood": sample["neighborhood"],
+        "business_type": sample["business_type"],
+        "unit_type": sample["unit_type"],
+        "min_area": 30,
+        "min_price": 0,
+        "max_price": 2000000,
+        "min_lat": float(sample["latitude"]),
+        "min_lon": float(sample["longitude"]),
+    }
+
+
+def check_hot_statements():
+    """
+    Report the hot statements whose plans still rely on sequential scans.
+    Small tables are often scanned sequentially on purpose, so results are
+    meaningful on production sized data
+    Returns:
+        Dictionary with the relations sequentially scanned by each statement
+    """
+    report = {}
+    with db_manager.get_connection() as conn:
+        parameters = get_sample_parameters(conn)
+        if parameters is None:
+            logger.warning("No listings found to plan hot statements with")
+            return report
+        for name, statement in HOT_STATEMENTS.items():
+            plan = conn.execute(
+                text(f"EXPLAIN (FORMAT JSON) {statement}"), parameters
+            ).scalar()
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            sequential_scans = find_sequential_scans(plan[0]["Plan"])
+            report[name] = sequential_scans
+            if sequential_scans:
+                logger.warning(f"{name} plans sequential scans on {', '.join(sequential_scans)}")
+            else:
+                logger.info(f"{name} uses indexes only")
+    return report
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "migrate"
+    if command == "migrate":
+        migrate()
+    elif command == "check":
+        check_hot_statements()
+    elif command == "partition":
+        partition_fact_listings()
+    else:
+        logger.error(f"Unknown command {command}, use migrate, check or partition")
+        sys.exit(1)
@@ -0,0 +1,127 @@
+import logging
+import os
+import threading
+import time
+from typing import Optional
+
+# Configure logging
+logging.basicConfig(
+    format="%(asctime)s %(name)-12s %(levelname)-8s %(message)s", level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(Exception):
+    """Raised when a request is short-circuited because its provider is failing"""
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker of an external provider. After failure_threshold failures in
+    a row requests are rejected right away, until reset_timeout passes and a
+    single trial request is let through to check if the provider recovered
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 60):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.rejected = 0
+        self.openings = 0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def before_request(self):
+        """Raise CircuitOpenError if a request can't be sent to the provider now"""
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    self.rejected += 1
+                    raise CircuitOpenError(f"{self.name} circuit is open")
+                self.state = self.HALF_OPEN
+            if self.state == self.HALF_OPEN:
+                # Only one trial request at a time while half open
+                if self._trial_in_flight:
+                    self.rejected += 1
+                    raise CircuitOpenError(f"{self.name} circuit is half open")
+                self._trial_in_flight = True
+
+    def record_success(self):
+        """Close the circuit after a successful request"""
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info(f"{self.name} circuit closed")
+            self.state = self.CLOSED
+            self.consecutive_failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        """Count a failed request, opening the circuit past the threshold"""
+        with self._lock:
+            self.consecutive_failures += 1
+            self._trial_in_flight = False
+            if (
+                self.state == self.HALF_OPEN
+                or self.consecutive_failures >= self.failure_threshold
+            ):
+                if self.state != self.OPEN:
+                    self.openings += 1
+                    logger.warning(
+                        f"{self.name} circuit opened after {self.consecutive_failures} failures"
+                    )
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+    def get_metrics(self) -> dict:
+        """Get the state and counters of the circuit"""
+        with self._lock:
+            return {
+                "state": self.state,
+                "openings": self.openings,
+                "rejected": self.rejected,
+            }
+
+
+class Deadline:
+    """Time budget, optionally capped by a parent budget"""
+
+    def __init__(self, seconds: Optional[float], parent: Optional["Deadline"] = None):
+        """
+        Args:
+            seconds (float): Seconds available, None for no limit
+            parent (Deadline): Budget this one is part of, e.g. the run of a neighborhood
+        """
+        self.seconds = seconds
+        self.parent = parent
+        self.expires_at = None if seconds is None else time.monotonic() + seconds
+
+    @classmethod
+    def from_env(cls, variable: str, parent: Optional["Deadline"] = None) -> "Deadline":
+        """Create a budget with the seconds on an environment variable, unlimited if not set"""
+        value = os.getenv(variable)
+        return cls(float(value) if value else None, parent=parent)
+
+    def remaining(self) -> Optional[float]:
+        """Get the seconds left, or None if there is no limit"""
+        remaining = None
+        if self.expires_at is not None:
+            remaining = self.expires_at - time.monotonic()
+        if self.parent is not None:
+            parent_remaining = self.parent.remaining()
+            if parent_remaining is not None:
+                remaining = (
+                    parent_remaining if remaining is None else min(remaining, parent_remaining)
+                )
+        return remaining
+
+    def expired(self) -> bool:
+        """Check if the budget is spent"""
+        remaining = self.remaining()
+        return remaining is not None and remaining <= 0
@@ -0,0 +1,258 @@
+import logging
+import math
+import os
+import random
+from typing import Optional
+
+import pandas as pd
+from sqlalchemy import text
+
+# Configure logging
+logging.basicConfig(
+    format="%(asctime)s %(name)-12s %(levelname)-8s %(message)s", level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+
+class NeighborhoodScheduler:
+    """
+    Orders the neighborhoods of a market by expected changed listings per second
+    of scraping, from their scrape history, and skips or samples low-churn ones
+    when a time budget is set
+    """
+
+    def __init__(
+        self,
+        db_manager,
+        history_runs: int = 5,
+        default_interval_days: float = 7,
+        default_cost_seconds: float = 300,
+        low_churn_quantile: float = 0.25,
+        sample_rate: Optional[float] = None,
+        max_staleness_days: float = 28,
+    ):
+        """
+        Args:
+            db_manager: Database manager
+            history_runs (int): Latest completed scrapes of a neighborhood used to estimate it
+            default_interval_days (float): Days assumed before the first scrape on history
+            default_cost_seconds (float): Cost assumed for neighborhoods without history
+            low_churn_quantile (float): Neighborhoods whose score is below this quantile are low churn
+            sample_rate (float): Share of low-churn neighborhoods scraped on a run,
+                by default ETL_LOW_CHURN_SAMPLE_RATE or 0.5
+            max_staleness_days (float): Neighborhoods not scraped for this long are always scraped
+        """
+        self.db_manager = db_manager
+        self.history_runs = history_runs
+        self.default_interval_days = default_interval_days
+        self.default_cost_seconds = default_cost_seconds
+        self.low_churn_quantile = low_churn_quantile
+        if sample_rate is None:
+            sample_rate = float(os.getenv("ETL_LOW_CHURN_SAMPLE_RATE", "0.5"))
+        self.sample_rate = sample_rate
+        self.max_staleness_days = max_staleness_days
+        # Time of the latest completed scrape of each planned neighborhood
+        self.last_scraped = {}
+
+    def get_history(self, city: str, business_type: str, unit_type: str) -> pd.DataFrame:
+        """
+        Get the latest completed scrapes of every neighborhood of a market, and its
+        latest full sweeps, as delta runs are much shorter and can't estimate cost
+        """
+        with self.db_manager.get_connection() as conn:
+            return pd.read_sql(
+                """
+                SELECT neighborhood, scraped_at, duration_seconds, n_changed, delta, run_number
+                FROM (
+                    SELECT
+                        neighborhood,
+                        scraped_at,
+                        duration_seconds,
+                        n_changed,
+                        delta,
+                        ROW_NUMBER() OVER (
+                            PARTITION BY neighborhood ORDER BY scraped_at DESC
+                        ) AS run_number,
+                        ROW_NUMBER() OVER (
+                            PARTITION BY neighborhood, delta ORDER BY scraped_at DESC
+                        ) AS kind_run_number
+                    FROM etl_neighborhood_history
+                    WHERE city = %(city)s
+                        AND business_type = %(business_type)s
+                        AND unit_type = %(unit_type)s
+                        AND completed
+                ) history
+                WHERE run_number <= %(history_runs)s
+                    OR (NOT delta AND kind_run_number <= %(history_runs)s)
+                """,
+                con=conn,
+                params={
+                    "city": city,
+                    "business_type": business_type,
+                    "unit_type": unit_type,
+                    "history_runs": self.history_runs + 1,
+                },
+                parse_dates=["scraped_at"],
+            )
+
+    def estimate(self, history: pd.DataFrame, now: pd.Timestamp) -> pd.DataFrame:
+        """
+        Estimate changes, cost and score of the neighborhoods on history
+        Returns:
+            DataFrame indexed by neighborhood with expected_changes, expected_cost,
+            days_since_scrape and score
+        """
+        estimates = {}
+        for neighborhood, scrapes in history.groupby("neighborhood"):
+            # Cost is estimated from full sweeps only, churn from every recent run
+            full_sweeps = scrapes[~scrapes["delta"]].nsmallest(self.history_runs, "run_number")
+            scrapes = scrapes[scrapes["run_number"] <= self.history_runs + 1]
+            scrapes = scrapes.sort_values("scraped_at")
+            # Days each scrape covered, since the previous one
+            intervals = scrapes["scraped_at"].diff().dt.total_seconds() / 86400
+            intervals = intervals.fillna(self.default_interval_days).clip(lower=1 / 24)
+            # The oldest scrape is only used to measure the interval of the next one
+            if len(scrapes) > self.history_runs:
+                scrapes, intervals = scrapes.iloc[1:], intervals.iloc[1:]
+            changes_per_day = (scrapes["n_changed"] / intervals).mean()
+            days_since_scrape = (now - scrapes["scraped_at"].max()).total_seconds() / 86400
+            expected_changes = changes_per_day * days_since_scrape
+            expected_cost = (
+                max(full_sweeps["duration_seconds"].mean(), 1.0) if not full_sweeps.empty else None
+            )
+            estimates[neighborhood] = {
+                "expected_changes": expected_changes,
+                "expected_cost": expected_cost,
+                "days_since_scrape": days_since_scrape,
+            }
+        estimates = pd.DataFrame.from_dict(
+            estimates,
+            orient="index",
+            columns=["expected_changes", "expected_cost", "days_since_scrape"],
+            dtype=float,
+        )
+        # Neighborhoods only scraped by delta runs cost as much as a typical full sweep
+        default_cost = estimates["expected_cost"].median()
+        if pd.isna(default_cost):
+            default_cost = self.default_cost_seconds
+        estimates["expected_cost"] = estimates["expected_cost"].fillna(default_cost)
+        estimates["score"] = estimates["expected_changes"] / estimates["expected_cost"]
+        return estimates
+
+    def plan(
+        self,
+        city: str,
+        business_type: str,
+        unit_type: str,
+        neighborhoods: list,
+        budget_seconds: Optional[float] = None,
+    ) -> list:
+        """
+        Order neighborhoods by expected changes per second of effort. Neighborhoods
+        without history go first. With a budget, low-churn ones are sampled, and once
+        the expected cost reaches it the remaining ones are skipped
+        Args:
+            city (str): City of the market
+            business_type (str): Business type of the market
+            unit_type (str): Unit type of the market, APARTMENT or HOME
+            neighborhoods (list): Neighborhoods requested for the market
+            budget_seconds (float): Time available, None for no limit
+        Returns:
+            Neighborhoods to scrape, in order
+        """
+        history = self.get_history(city, business_type, unit_type)
+        history = history[history["neighborhood"].isin(neighborhoods)]
+        now = pd.Timestamp.now(tz="UTC")
+        estimates = self.estimate(history, now)
+        self.last_scraped = history.groupby("neighborhood")["scraped_at"].max().to_dict()
+        default_cost = (
+            estimates["expected_cost"].median() if not estimates.empty else self.default_cost_seconds
+        )
+        low_churn_score = (
+            estimates["score"].quantile(self.low_churn_quantile)
+            if len(estimates) > 1
+            else -math.inf
+        )
+
+        def get_priority(neighborhood):
+            if neighborhood not in estimates.index:
+                return math.inf
+            return estimates.loc[neighborhood, "score"]
+
+        # Sorting is stable, so ties keep the requested order
+        ordered = sorted(dict.fromkeys(neighborhoods), key=get_priority, reverse=True)
+        planned = []
+        spent = 0.0
+        for neighborhood in ordered:
+            if neighborhood in estimates.index:
+                estimate = estimates.loc[neighborhood]
+                cost = estimate["expected_cost"]
+                is_low_churn = (
+                    estimate["score"] <= low_churn_score
+                    and estimate["days_since_scrape"] < self.max_staleness_days
+                )
+                # Without a budget every neighborhood is scraped
+                if (
+                    budget_seconds is not None
+                    and is_low_churn
+                    and random.random() >= self.sample_rate
+                ):
+                    logger.info(
+                        f"Skipping low churn neighborhood {neighborhood}, "
+                        f"{estimate['expected_changes']:.1f} changes expected"
+                    )
+                    continue
+            else:
+                cost = default_cost
+            if budget_seconds is not None and planned and spent + cost > budget_seconds:
+                logger.info(f"Skipping neighborhood {neighborhood}, over the time budget")
+                continue
+            planned.append(neighborhood)
+            spent += cost
+        logger.info(
+            f"Planned {len(planned)} of {len(ordered)} neighborhoods, "
+            f"{spent / 60:.0f} minutes expected"
+        )
+        return planned
+
+    def record(
+        self,
+        city: str,
+        business_type: str,
+        unit_type: str,
+        neighborhood: str,
+        duration_seconds: float,
+        n_pages: int,
+        n_listings: int,
+        n_changed: int,
+        completed: bool,
+        delta: bool = False,
+    ):
+        """Save the outcome of a neighborhood scrape to its history, delta for delta runs"""
+        with self.db_manager.get_transaction() as conn:
+            conn.execute(
+                text(
+                    """
+                    INSERT INTO etl_neighborhood_history (
+                        city, business_type, unit_type, neighborhood, duration_seconds,
+                        n_pages, n_listings, n_changed, completed, delta
+                    )
+                    VALUES (
+                        :city, :business_type, :unit_type, :neighborhood, :duration_seconds,
+                        :n_pages, :n_listings, :n_changed, :completed, :delta
+                    )
+                    """
+                ),
+                {
+                    "city": city,
+                    "business_type": business_type,
+                    "unit_type": unit_type,
+                    "neighborhood": neighborhood,
+                    "duration_seconds": duration_seconds,
+                    "n_pages": n_pages,
+                    "n_listings": n_listings,
+                    "n_changed": n_changed,
+                    "completed": completed,
+                    "delta": delta,
+                },
+            )
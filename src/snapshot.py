@@ -0,0 +1,252 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+import pandas as pd
+
+# Configure logging
+logging.basicConfig(
+    format="%(asctime)s %(name)-12s %(levelname)-8s %(message)s", level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+
+class ReferenceSnapshot:
+    """
+    Local SQLite snapshot of the reference tables used by every ETL run,
+    refreshed by delta sync so warm starts only pull rows added since the last sync
+    """
+
+    # Local tables and the remote columns they mirror
+    analysis_tables = {
+        "fact_image_analysis": ["green_density", "is_next_to_park"],
+        "fact_traffic_analysis": ["n_nearby_bus_lanes"],
+    }
+    # Rows committed around the last sync are pulled again, in case they became
+    # visible only after the watermark was taken
+    sync_lookback = "10 minutes"
+
+    def __init__(self, db_manager, path: Optional[str] = None):
+        self.db_manager = db_manager
+        self.path = path or os.getenv(
+            "REFERENCE_SNAPSHOT_PATH", os.path.join(".cache", "reference_snapshot.sqlite")
+        )
+        self._sync_lock = threading.Lock()
+
+    @contextmanager
+    def get_local_connection(self):
+        """Context manager for connections to the local snapshot"""
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(self.path)
+        try:
+            self._create_local_tables(conn)
+            yield conn
+            conn.commit()
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _create_local_tables(conn):
+        """Create local tables and indexes if they don't exist yet"""
+        conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS sync_state (
+                name TEXT PRIMARY KEY,
+                watermark TEXT,
+                synced_at REAL
+            );
+            CREATE TABLE IF NOT EXISTS dim_zip_code (
+                zip_code TEXT PRIMARY KEY,
+                complement TEXT
+            );
+            CREATE TABLE IF NOT EXISTS fact_image_analysis (
+                id INTEGER PRIMARY KEY,
+                min_lat REAL, max_lat REAL, min_lon REAL, max_lon REAL,
+                green_density REAL,
+                is_next_to_park INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS fact_image_analysis_corner_idx
+                ON fact_image_analysis (min_lat, min_lon);
+            CREATE TABLE IF NOT EXISTS fact_traffic_analysis (
+                id INTEGER PRIMARY KEY,
+                min_lat REAL, max_lat REAL, min_lon REAL, max_lon REAL,
+                n_nearby_bus_lanes INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS fact_traffic_analysis_corner_idx
+                ON fact_traffic_analysis (min_lat, min_lon);
+            CREATE TABLE IF NOT EXISTS city_neighborhoods (
+                state TEXT,
+                city TEXT,
+                neighborhood TEXT
+            );
+            """
+        )
+
+    @staticmethod
+    def _get_sync_state(conn, name: str) -> tuple:
+        """Get the watermark and last sync time for a synced item"""
+        row = conn.execute(
+            "SELECT watermark, synced_at FROM sync_state WHERE name = ?", (name,)
+        ).fetchone()
+        return row if row is not None else (None, None)
+
+    @staticmethod
+    def _set_sync_state(conn, name: str, watermark):
+        """Save the watermark of a synced item"""
+        conn.execute(
+            "INSERT OR REPLACE INTO sync_state (name, watermark, synced_at) VALUES (?, ?, ?)",
+            (name, None if watermark is None else str(watermark), time.time()),
+        )
+
+    def sync_zip_codes(self):
+        """
+        Pull zip codes created since the last sync into the local snapshot.
+        Relies on the created_at watermark added by the migrations
+        """
+        with self._sync_lock, self.get_local_connection() as local_conn:
+            watermark, _ = self._get_sync_state(local_conn, "dim_zip_code")
+            query = "SELECT zip_code, complement, created_at FROM dim_zip_code"
+            params = {}
+            if watermark is not None:
+                query += f" WHERE created_at > %(watermark)s::timestamptz - interval '{self.sync_lookback}'"
+                params["watermark"] = watermark
+            with self.db_manager.get_connection() as conn:
+                new_zip_codes = pd.read_sql(query, con=conn, params=params or None)
+            if not new_zip_codes.empty:
+                local_conn.executemany(
+                    "INSERT OR REPLACE INTO dim_zip_code (zip_code, complement) VALUES (?, ?)",
+                    new_zip_codes[["zip_code", "complement"]].itertuples(index=False, name=None),
+                )
+                watermark = pd.to_datetime(new_zip_codes["created_at"], utc=True).max().isoformat()
+            self._set_sync_state(local_conn, "dim_zip_code", watermark)
+        logger.info(f"Synced {len(new_zip_codes)} zip codes to the local snapshot")
+
+    def sync_analysis(self):
+        """
+        Pull analysis tiles created since the last sync into the local snapshot.
+        Tiles are written by concurrent markets and background writers, so their
+        ids don't commit in order: the created_at watermark added by the migrations
+        is used instead, with the same lookback as zip codes
+        """
+        with self._sync_lock, self.get_local_connection() as local_conn:
+            for table, value_columns in self.analysis_tables.items():
+                # Snapshots synced by id before are pulled again in full once
+                name = f"{table}:created_at"
+                watermark, _ = self._get_sync_state(local_conn, name)
+                columns = ["id", "min_lat", "max_lat", "min_lon", "max_lon", *value_columns]
+                query = f"SELECT {', '.join(columns)}, created_at FROM {table}"
+                params = {}
+                if watermark is not None:
+                    query += f" WHERE created_at > %(watermark)s::timestamptz - interval '{self.sync_lookback}'"
+                    params["watermark"] = watermark
+                with self.db_manager.get_connection() as conn:
+                    new_tiles = pd.read_sql(query, con=conn, params=params or None)
+                if not new_tiles.empty:
+                    watermark = pd.to_datetime(new_tiles["created_at"], utc=True).max().isoformat()
+                    new_tiles = new_tiles[columns].astype(object).where(new_tiles[columns].notna(), None)
+                    local_conn.executemany(
+                        f"""
+                        INSERT OR REPLACE INTO {table} ({', '.join(columns)})
+                        VALUES ({', '.join('?' * len(columns))})
+                        """,
+                        new_tiles.itertuples(index=False, name=None),
+                    )
+                self._set_sync_state(local_conn, name, watermark)
+                logger.info(f"Synced {len(new_tiles)} {table} tiles to the local snapshot")
+
+    def get_zip_codes(self) -> pd.DataFrame:
+        """Get all zip codes, indexed by zip code, after a delta sync"""
+        self.sync_zip_codes()
+        with self.get_local_connection() as local_conn:
+            return pd.read_sql(
+                "SELECT zip_code, complement FROM dim_zip_code",
+                con=local_conn,
+                index_col="zip_code",
+            )
+
+    def get_analysis_data(self, bounding_box: Optional[tuple] = None) -> dict:
+        """
+        Get image and traffic analysis tiles intersecting a bounding box after a delta sync
+        Args:
+            bounding_box (tuple): min_lat, max_lat, min_lon and max_lon of the searched area,
+                if None all tiles are returned
+        """
+        self.sync_analysis()
+        with self.get_local_connection() as local_conn:
+            image_analysis = self._read_local_tiles(
+                local_conn, "fact_image_analysis", bounding_box, tile_size=0.01
+            )
+            traffic_analysis = self._read_local_tiles(
+                local_conn, "fact_traffic_analysis", bounding_box, tile_size=0.001
+            )
+        image_analysis["is_next_to_park"] = image_analysis["is_next_to_park"].map(
+            lambda value: None if pd.isna(value) else bool(value)
+        )
+        return {
+            "image_analysis": image_analysis,
+            "traffic_analysis": traffic_analysis,
+        }
+
+    def _read_local_tiles(
+        self, local_conn, table: str, bounding_box: Optional[tuple], tile_size: float
+    ) -> pd.DataFrame:
+        """Read the local tiles of an analysis table that intersect a bounding box"""
+        columns_str = ", ".join(
+            ["min_lat", "max_lat", "min_lon", "max_lon", *self.analysis_tables[table]]
+        )
+        if bounding_box is None:
+            return pd.read_sql(f"SELECT {columns_str} FROM {table}", con=local_conn)
+        min_lat, max_lat, min_lon, max_lon = bounding_box
+        return pd.read_sql(
+            f"""
+            SELECT {columns_str}
+            FROM {table}
+            WHERE
+                min_lat BETWEEN :lower_lat AND :max_lat
+                AND min_lon BETWEEN :lower_lon AND :max_lon
+                AND max_lat >= :min_lat
+                AND max_lon >= :min_lon
+            """,
+            con=local_conn,
+            params={
+                "lower_lat": min_lat - tile_size,
+                "lower_lon": min_lon - tile_size,
+                "min_lat": min_lat,
+                "max_lat": max_lat,
+                "min_lon": min_lon,
+                "max_lon": max_lon,
+            },
+        )
+
+    def get_neighborhoods(
+        self, state: str, city: str, loader: Callable, max_age_days: int = 30
+    ) -> list:
+        """
+        Get the neighborhoods of a city from the snapshot, downloading them again
+        with the loader when they are missing or older than max_age_days
+        """
+        name = f"city_neighborhoods:{state}:{city}"
+        with self._sync_lock, self.get_local_connection() as local_conn:
+            _, synced_at = self._get_sync_state(local_conn, name)
+            if synced_at is not None and time.time() - synced_at < max_age_days * 86400:
+                rows = local_conn.execute(
+                    "SELECT neighborhood FROM city_neighborhoods WHERE state = ? AND city = ?",
+                    (state, city),
+                ).fetchall()
+                return sorted(row[0] for row in rows)
+            neighborhoods = loader(state, city)
+            local_conn.execute(
+                "DELETE FROM city_neighborhoods WHERE state = ? AND city = ?", (state, city)
+            )
+            local_conn.executemany(
+                "INSERT INTO city_neighborhoods (state, city, neighborhood) VALUES (?, ?, ?)",
+                [(state, city, neighborhood) for neighborhood in neighborhoods],
+            )
+            self._set_sync_state(local_conn, name, None)
+        return neighborhoods
@@ -0,0 +1,136 @@
+import logging
+import threading
+import time
+
+# Configure logging
+logging.basicConfig(
+    format="%(asctime)s %(name)-12s %(levelname)-8s %(message)s", level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+
+class AdaptiveRateLimiter:
+    """
+    Token bucket whose rate adapts to the provider: it grows additively while
+    requests succeed and is cut multiplicatively on throttling, server errors or
+    slow responses (AIMD). Shared by every thread sending requests to the provider
+    """
+
+    def __init__(
+        self,
+        name: str,
+        rate: float,
+        min_rate: float,
+        max_rate: float,
+        target_latency: float,
+        additive_increase: float = 0.1,
+        decrease_factor: float = 0.5,
+        cooldown: float = 1.0,
+    ):
+        """
+        Args:
+            name (str): Provider name, used on logs and metrics
+            rate (float): Initial rate, in requests per second
+            min_rate (float): Lowest rate the limiter backs off to
+            max_rate (float): Highest rate the limiter grows to
+            target_latency (float): Latency, in seconds, above which the rate is reduced
+            additive_increase (float): Requests per second added per second of success
+            decrease_factor (float): Factor applied to the rate on throttling or errors
+            cooldown (float): Seconds after a decrease in which new signals are ignored,
+                so a burst of errors from concurrent requests cuts the rate only once
+        """
+        self.name = name
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.target_latency = target_latency
+        self.additive_increase = additive_increase
+        self.decrease_factor = decrease_factor
+        self.cooldown = cooldown
+        # Burst is limited to one second of requests
+        self._tokens = 1.0
+        self._last_refill = time.monotonic()
+        self._last_decrease = 0.0
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.throttled = 0
+        self.server_errors = 0
+        self.connection_errors = 0
+        self.slow_responses = 0
+        self.decreases = 0
+        self.waited_seconds = 0.0
+
+    def _refill(self, now: float):
+        """Add the tokens earned since the last refill"""
+        capacity = max(1.0, self.rate)
+        self._tokens = min(capacity, self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    def acquire(self):
+        """Block until a request can be sent"""
+        start = time.monotonic()
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    self.requests += 1
+                    self.waited_seconds += now - start
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def _decrease(self, reason: str):
+        """Cut the rate multiplicatively, at most once per cooldown"""
+        now = time.monotonic()
+        if now - self._last_decrease < self.cooldown:
+            return
+        previous_rate = self.rate
+        self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+        self._last_decrease = now
+        self.decreases += 1
+        logger.info(
+            f"Reduced {self.name} rate from {previous_rate:.2f} to {self.rate:.2f} req/s after {reason}"
+        )
+
+    def record(self, status_code: int, latency: float):
+        """
+        Adapt the rate to the outcome of a request
+        Args:
+            status_code (int): Status code of the response
+            latency (float): Seconds the response took
+        """
+        with self._lock:
+            if status_code == 429:
+                self.throttled += 1
+                self._decrease("throttling")
+            elif status_code >= 500:
+                self.server_errors += 1
+                self._decrease(f"status {status_code}")
+            elif latency > self.target_latency:
+                self.slow_responses += 1
+                self._decrease(f"a {latency:.1f}s response")
+            else:
+                # Grows by about additive_increase per second at the current rate
+                self.rate = min(self.max_rate, self.rate + self.additive_increase / self.rate)
+
+    def record_error(self):
+        """Adapt the rate to a request that failed without a response"""
+        with self._lock:
+            self.connection_errors += 1
+            self._decrease("a connection error")
+
+    def get_metrics(self) -> dict:
+        """Get the current rate and throttling counters"""
+        with self._lock:
+            return {
+                "rate": round(self.rate, 3),
+                "requests": self.requests,
+                "throttled": self.throttled,
+                "server_errors": self.server_errors,
+                "connection_errors": self.connection_errors,
+                "slow_responses": self.slow_responses,
+                "decreases": self.decreases,
+                "waited_seconds": round(self.waited_seconds, 3),
+            }
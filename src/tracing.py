@@ -0,0 +1,174 @@
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+import numpy as np
+
+# Configure logging
+logging.basicConfig(
+    format="%(asctime)s %(name)-12s %(levelname)-8s %(message)s", level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+
+class Span:
+    """Timed stage of the run, with attributes such as neighborhood, page and rows"""
+
+    __slots__ = ("name", "start", "duration", "thread_id", "attributes")
+
+    def __init__(self, name: str, attributes: dict):
+        self.name = name
+        self.start = time.perf_counter()
+        self.duration = None
+        self.thread_id = threading.get_ident()
+        self.attributes = attributes
+
+
+class Tracer:
+    """
+    Lightweight tracer of the stages of a run. Spans are kept in memory and
+    summarized by the end of the run into totals and percentiles per stage, and
+    can be exported in the Chrome trace event format, opened on chrome://tracing
+    or https://ui.perfetto.dev. Stages nested in others count on both
+    """
+
+    def __init__(self, max_spans: int = 500000):
+        """
+        Args:
+            max_spans (int): Spans kept for the trace export, stages are still
+                summarized past it
+        """
+        self.max_spans = max_spans
+        self.started_at = time.perf_counter()
+        self._spans = []
+        self._durations = {}
+        self._rows = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        """
+        Time the block as a stage. Attributes can be added to the yielded span,
+        e.g. span.attributes["rows"] = len(df)
+        Args:
+            name (str): Name of the stage
+            attributes: Attributes of the span, like neighborhood or page
+        """
+        span = Span(name, attributes)
+        try:
+            yield span
+        finally:
+            span.duration = time.perf_counter() - span.start
+            self._record(span)
+
+    def traced(self, name: str, rows: Optional[str] = None):
+        """
+        Decorate a function or method to time it as a stage. The neighborhood and
+        page number of the object it is called on are added as attributes
+        Args:
+            name (str): Name of the stage
+            rows (str): Attribute of the object holding the rows processed,
+                counted after the call
+        """
+
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                owner = args[0] if args else None
+                attributes = {}
+                for attribute, key in (("neighborhood", "neighborhood"), ("page_number", "page")):
+                    value = getattr(owner, attribute, None)
+                    if isinstance(value, (str, int)):
+                        attributes[key] = value
+                with self.span(name, **attributes) as span:
+                    result = function(*args, **kwargs)
+                    if rows is not None:
+                        value = getattr(owner, rows, None)
+                        if value is not None:
+                            span.attributes["rows"] = len(value)
+                    return result
+
+            return wrapper
+
+        return decorator
+
+    def _record(self, span: Span):
+        """Keep a finished span and add it to its stage totals"""
+        with self._lock:
+            self._durations.setdefault(span.name, []).append(span.duration)
+            rows = span.attributes.get("rows")
+            if rows is not None:
+                self._rows[span.name] = self._rows.get(span.name, 0) + rows
+            if len(self._spans) < self.max_spans:
+                self._spans.append(span)
+
+    def get_report(self) -> dict:
+        """
+        Get totals and percentiles of each stage, slowest stages first
+        Returns:
+            Dictionary with the run duration and the stages, by name
+        """
+        with self._lock:
+            durations = {name: np.array(values) for name, values in self._durations.items()}
+            rows = dict(self._rows)
+        stages = {}
+        for name, values in sorted(durations.items(), key=lambda item: -item[1].sum()):
+            p50, p90, p99 = np.percentile(values, [50, 90, 99])
+            stages[name] = {
+                "count": int(values.size),
+                "total_seconds": round(float(values.sum()), 4),
+                "mean_seconds": round(float(values.mean()), 6),
+                "p50_seconds": round(float(p50), 6),
+                "p90_seconds": round(float(p90), 6),
+                "p99_seconds": round(float(p99), 6),
+                "max_seconds": round(float(values.max()), 6),
+            }
+            if name in rows:
+                stages[name]["rows"] = rows[name]
+        return {
+            "run_seconds": round(time.perf_counter() - self.started_at, 3),
+            "stages": stages,
+        }
+
+    def export_chrome_trace(self, path: str):
+        """Write the spans as complete events of the Chrome trace event format"""
+        with self._lock:
+            spans = list(self._spans)
+        events = [
+            {
+                "name": span.name,
+                "ph": "X",
+                "ts": round((span.start - self.started_at) * 1e6, 1),
+                "dur": round(span.duration * 1e6, 1),
+                "pid": os.getpid(),
+                "tid": span.thread_id,
+                "args": span.attributes,
+            }
+            for span in spans
+        ]
+        with open(path, "w") as file:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, file, default=str)
+        logger.info(f"Exported {len(events)} spans to {path}")
+
+    def emit_report(self):
+        """
+        Log the report of the run as JSON, writing it to ETL_TRACE_REPORT_PATH and the
+        trace to ETL_TRACE_EXPORT_PATH when they are set
+        """
+        report = self.get_report()
+        logger.info(f"Run report: {json.dumps(report)}")
+        report_path = os.getenv("ETL_TRACE_REPORT_PATH")
+        if report_path:
+            with open(report_path, "w") as file:
+                json.dump(report, file, indent=2)
+        export_path = os.getenv("ETL_TRACE_EXPORT_PATH")
+        if export_path:
+            self.export_chrome_trace(export_path)
+
+
+tracer = Tracer()
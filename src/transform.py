@@ -1,8 +1,12 @@
 import logging
+import re
 import textwrap
 import pandas as pd
+from requests.exceptions import RequestException
 from sqlalchemy import text
-from src.database import db_manager
+from src.database import db_manager, bulk_ops, bulk_loader, data_cache
+from src.resilience import CircuitOpenError
+from src.tracing import tracer
 import src.extract as extract
 
 # Configure logging
@@ -34,6 +38,55 @@ def convert_to_dataframe(data):
     return df
 
 
+# Flags derived from listing descriptions, matched against lowercase text
+# without accents. New flags only need a pattern here and a boolean column
+DESCRIPTION_FLAG_PATTERNS = {
+    "is_remodeled": re.compile(r"\breformad[oa]s?\b"),
+    "is_furnished": re.compile(r"\b(?:semi[- ]?)?mobiliad[oa]s?\b"),
+    "has_sea_view": re.compile(r"\bvista (?:para o |pro )?mar\b|\bfrente (?:para o |ao )?mar\b|\bpe na areia\b"),
+    "is_new_building": re.compile(
+        r"\b(?:apartamento|apto|imovel|predio|edificio|casa|condominio) novo\b"
+        r"|\bnunca habitad[oa]\b|\bprimeira locacao\b|\blancamento\b"
+    ),
+    "has_balcony": re.compile(r"\bvarandas?\b|\bvarandao\b|\bsacadas?\b"),
+    "has_pool": re.compile(r"\bpiscinas?\b"),
+}
+
+
+def normalize_text(texts):
+    """
+    Lowercase texts and strip their accents, e.g. "Reformadíssimo" to "reformadissimo"
+    Args:
+        texts (pd.Series): Texts to normalize
+    """
+    return (
+        texts.fillna("")
+        .astype(str)
+        .str.normalize("NFKD")
+        .str.encode("ascii", errors="ignore")
+        .str.decode("ascii")
+        .str.lower()
+    )
+
+
+def extract_description_flags(descriptions):
+    """
+    Derive boolean flags from listing descriptions, normalizing all of them at once
+    Args:
+        descriptions (pd.Series): Listing descriptions
+    Returns:
+        DataFrame with one boolean column per flag, sharing the descriptions index
+    """
+    normalized_descriptions = normalize_text(descriptions)
+    return pd.DataFrame(
+        {
+            flag: normalized_descriptions.str.contains(pattern)
+            for flag, pattern in DESCRIPTION_FLAG_PATTERNS.items()
+        },
+        index=descriptions.index,
+    )
+
+
 def wrap_string_with_fill(text, width):
     wrapped_text = textwrap.fill(text, width)
     return wrapped_text.replace('\n', '<br>')
@@ -55,6 +108,7 @@ def define_bounding_box(latitude, longitude, height=0.01, width=0.01):
     return min_lat, max_lat, min_lon, max_lon
 
 
+@tracer.traced("transform.calculate_green_density")
 def calculate_green_density(image):
 
     if image is not None:
@@ -85,80 +139,266 @@ def calculate_green_density(image):
 
 
 
-def group_green_density(city):
-    """Group green density into quartiles with optimized database access"""
-    logger.info("Grouping green_density into quartiles")
-    with db_manager.get_transaction() as conn:
-        query = text(
-            """with quartile_green_density as (select
-                        CASE
-                            WHEN NTILE(3) OVER (
-                            ORDER BY
-                                green_density
-                            ) = 3 THEN 'Bastante Verde'
-                            WHEN NTILE(3) OVER (
-                            ORDER BY
-                                green_density
-                            ) = 2 THEN 'Moderadamente Verde'
-                            WHEN NTILE(3) OVER (
-                            ORDER BY
-                                green_density
-                            ) = 1 and is_next_to_park is False THEN 'Pouco Verde'
-                            WHEN is_next_to_park is True THEN 'Moderadamente Verde'
-                        END as green_density_grouped,
-                        listing_id
-                        from
-                        fact_listings
-                        where city = :city
-                        )
-                        UPDATE fact_listings SET green_density_grouped = quartile_green_density.green_density_grouped
-                        FROM quartile_green_density
-                        WHERE fact_listings.listing_id = quartile_green_density.listing_id
-                        and city = :city;
-        """)
-        parameters = {
-            "city": city,
-        }
-        conn.execute(query, parameters)
-    return
+def get_market_condition(business_type=None):
+    """
+    Get the SQL condition restricting a statement to a business type, so it only
+    reads or writes the fact_listings partition of that market
+    """
+    if business_type is None:
+        return ""
+    return "and fact_listings.business_type = :business_type"
+
 
-def group_n_bus_lanes(city):
-    """Group nearby bus lanes into quartiles with optimized database access"""
-    logger.info("Grouping n_nearby_bus_lanes into quartiles")
+@tracer.traced("transform.update_derived_columns")
+def update_derived_columns(city, business_type=None):
+    """
+    Compute every grouped column of a market in a single pass, evaluating each
+    window once, and only write listings whose grouped values changed. Groups
+    are tiles of the whole city, as the app shows them.
+    Flags derived from descriptions are set when listings are parsed instead
+    Args:
+        city (str): City whose listings are updated
+        business_type (str): If given, only listings of this business type are written,
+            grouped against the whole city
+    Returns:
+        Number of listings updated
+    """
+    logger.info("Updating derived columns")
+    market_condition = get_market_condition(business_type)
     with db_manager.get_transaction() as conn:
         query = text(
-            """WITH quartile_n_nearby_bus_lanes AS (
-                        select CASE
-                                    WHEN NTILE(4) OVER (ORDER BY n_nearby_bus_lanes) = 1 THEN 'Muito Calmo'
-                                    WHEN NTILE(4) OVER (ORDER BY n_nearby_bus_lanes) = 2 THEN 'Calmo'
-                                    WHEN NTILE(4) OVER (ORDER BY n_nearby_bus_lanes) = 3 THEN 'Movimentado'
-                                    WHEN NTILE(4) OVER (ORDER BY n_nearby_bus_lanes) = 4 THEN 'Agitado'
-                                END as n_nearby_bus_lanes_grouped,
-                                listing_id
-                        from fact_listings
-                        where city = :city
-                        ) 
-                    UPDATE fact_listings SET n_nearby_bus_lanes_grouped = quartile_n_nearby_bus_lanes.n_nearby_bus_lanes_grouped
-                    FROM quartile_n_nearby_bus_lanes
-                    WHERE fact_listings.listing_id = quartile_n_nearby_bus_lanes.listing_id
-                    and city = :city;
-                """)
+            f"""
+            WITH tiles AS (
+                SELECT
+                    listing_id,
+                    business_type,
+                    is_next_to_park,
+                    NTILE(3) OVER (ORDER BY green_density) AS green_density_tile,
+                    NTILE(4) OVER (ORDER BY n_nearby_bus_lanes) AS n_nearby_bus_lanes_tile
+                FROM fact_listings
+                WHERE city = :city
+            ),
+            derived AS (
+                SELECT
+                    listing_id,
+                    business_type,
+                    CASE
+                        WHEN green_density_tile = 3 THEN 'Bastante Verde'
+                        WHEN green_density_tile = 2 THEN 'Moderadamente Verde'
+                        WHEN green_density_tile = 1 and is_next_to_park is False THEN 'Pouco Verde'
+                        WHEN is_next_to_park is True THEN 'Moderadamente Verde'
+                    END AS green_density_grouped,
+                    CASE n_nearby_bus_lanes_tile
+                        WHEN 1 THEN 'Muito Calmo'
+                        WHEN 2 THEN 'Calmo'
+                        WHEN 3 THEN 'Movimentado'
+                        WHEN 4 THEN 'Agitado'
+                    END AS n_nearby_bus_lanes_grouped
+                FROM tiles
+            )
+            UPDATE fact_listings
+            SET
+                green_density_grouped = derived.green_density_grouped,
+                n_nearby_bus_lanes_grouped = derived.n_nearby_bus_lanes_grouped
+            FROM derived
+            WHERE fact_listings.listing_id = derived.listing_id
+            and fact_listings.business_type = derived.business_type
+            and city = :city
+            {market_condition}
+            and (
+                fact_listings.green_density_grouped,
+                fact_listings.n_nearby_bus_lanes_grouped
+            ) IS DISTINCT FROM (
+                derived.green_density_grouped,
+                derived.n_nearby_bus_lanes_grouped
+            );
+            """
+        )
         parameters = {
             "city": city,
+            "business_type": business_type,
         }
-        conn.execute(query, parameters)
-    return
+        result = conn.execute(query, parameters)
+    logger.info(f"Updated derived columns of {result.rowcount} listings")
+    return result.rowcount
 
-def flag_remodeled_properties():
-    """Flag remodeled properties with optimized database access"""
-    logger.info("Flagging remodeled properties")
+
+def get_tile_key(min_lat, max_lat, min_lon, max_lon):
+    """Get a hashable key for an analysis tile"""
+    return tuple(round(float(value), 3) for value in (min_lat, max_lat, min_lon, max_lon))
+
+
+@tracer.traced("transform.backfill_pending_enrichment")
+def backfill_pending_enrichment(city, business_type=None, limit=1000, deadline=None):
+    """
+    Fill green density, park proximity and bus lanes of listings saved with pending
+    enrichment, because a provider's circuit was open or a time budget ran out.
+    Tiles already analysed are reused, and a provider is skipped for the rest of
+    the backfill once it fails. Listings never attempted go first, then the ones
+    attempted longest ago, so listings that keep failing don't hold back the others
+    Args:
+        city (str): City whose listings are backfilled
+        business_type (str): If given, only this business type's listings are backfilled
+        limit (int): Max number of listings backfilled
+        deadline (Deadline): Time budget, the backfill stops once it is spent
+    Returns:
+        Number of listings updated
+    """
+    market_condition = get_market_condition(business_type)
+    with db_manager.get_connection() as conn:
+        pending = pd.read_sql(
+            text(
+                f"""
+                SELECT listing_id, business_type, latitude, longitude
+                FROM fact_listings
+                WHERE city = :city
+                {market_condition}
+                and latitude IS NOT NULL
+                and longitude IS NOT NULL
+                and (
+                    green_density IS NULL
+                    or is_next_to_park IS NULL
+                    or n_nearby_bus_lanes IS NULL
+                )
+                ORDER BY enrichment_attempted_at NULLS FIRST, listing_id
+                LIMIT :limit
+                """
+            ),
+            con=conn,
+            params={"city": city, "business_type": business_type, "limit": limit},
+        )
+    pending = pending.dropna(subset=["latitude", "longitude"])
+    if pending.empty:
+        return 0
+    logger.info(f"Backfilling enrichment of {len(pending)} listings")
+    analysis_data = bulk_ops.bulk_get_analysis_data(
+        (
+            pending["latitude"].min(),
+            pending["latitude"].max(),
+            pending["longitude"].min(),
+            pending["longitude"].max(),
+        )
+    )
+    image_tiles = {
+        get_tile_key(row.min_lat, row.max_lat, row.min_lon, row.max_lon): (
+            row.green_density,
+            row.is_next_to_park,
+        )
+        for row in analysis_data["image_analysis"].itertuples()
+        if pd.notna(row.green_density) and pd.notna(row.is_next_to_park)
+    }
+    traffic_tiles = {
+        get_tile_key(row.min_lat, row.max_lat, row.min_lon, row.max_lon): row.n_nearby_bus_lanes
+        for row in analysis_data["traffic_analysis"].itertuples()
+        if pd.notna(row.n_nearby_bus_lanes)
+    }
+    new_image_tiles = []
+    new_traffic_tiles = []
+    image_available = True
+    traffic_available = True
+    updates = []
+    attempted = []
+    for listing in pending.itertuples():
+        if deadline is not None and deadline.expired():
+            logger.info("Backfill stopped, time budget spent")
+            break
+        attempted.append(listing)
+        image_tile = define_bounding_box(listing.latitude, listing.longitude)
+        image_key = get_tile_key(*image_tile)
+        if image_key not in image_tiles and image_available:
+            try:
+                image = extract.get_sat_image(*image_tile)
+                min_lat, max_lat, min_lon, max_lon = image_tile
+                next_to_park = extract.is_next_to_park(
+                    float(min_lat + max_lat) / 2, float(min_lon + max_lon) / 2
+                )
+                image_tiles[image_key] = (calculate_green_density(image), next_to_park)
+                new_image_tiles.append((*image_tile, *image_tiles[image_key]))
+            except (CircuitOpenError, RequestException) as error:
+                logger.info(f"Image analysis unavailable, skipping it: {error}")
+                image_available = False
+        traffic_tile = define_bounding_box(
+            listing.latitude, listing.longitude, height=0.001, width=0.001
+        )
+        traffic_key = get_tile_key(*traffic_tile)
+        if traffic_key not in traffic_tiles and traffic_available:
+            try:
+                traffic_tiles[traffic_key] = extract.get_n_bus_lines(*traffic_tile)
+                new_traffic_tiles.append((*traffic_tile, traffic_tiles[traffic_key]))
+            except (CircuitOpenError, RequestException) as error:
+                logger.info(f"Traffic analysis unavailable, skipping it: {error}")
+                traffic_available = False
+        green_density, next_to_park = image_tiles.get(image_key, (None, None))
+        n_nearby_bus_lanes = traffic_tiles.get(traffic_key)
+        if green_density is None and n_nearby_bus_lanes is None:
+            continue
+        updates.append(
+            {
+                "listing_id": listing.listing_id,
+                "city": city,
+                "business_type": listing.business_type,
+                "green_density": None if green_density is None else float(green_density),
+                "is_next_to_park": None if next_to_park is None else bool(next_to_park),
+                "n_nearby_bus_lanes": None if n_nearby_bus_lanes is None else int(n_nearby_bus_lanes),
+            }
+        )
     with db_manager.get_transaction() as conn:
-        query = text(
-            """
-            UPDATE 
-            fact_listings 
-            SET is_remodeled = True
-            WHERE description ILIKE '%reformado%' OR description ILIKE '%reformada%';
-                """)
-        conn.execute(query)
-    return
\ No newline at end of file
+        if new_image_tiles:
+            bulk_loader.copy_dataframe(
+                conn,
+                pd.DataFrame(
+                    new_image_tiles,
+                    columns=["min_lat", "max_lat", "min_lon", "max_lon", "green_density", "is_next_to_park"],
+                ),
+                "fact_image_analysis",
+            )
+        if new_traffic_tiles:
+            bulk_loader.copy_dataframe(
+                conn,
+                pd.DataFrame(
+                    new_traffic_tiles,
+                    columns=["min_lat", "max_lat", "min_lon", "max_lon", "n_nearby_bus_lanes"],
+                ),
+                "fact_traffic_analysis",
+            )
+        if updates:
+            # Values found on earlier runs are kept
+            conn.execute(
+                text(
+                    """
+                    UPDATE fact_listings
+                    SET
+                        green_density = COALESCE(green_density, :green_density),
+                        is_next_to_park = COALESCE(is_next_to_park, :is_next_to_park),
+                        n_nearby_bus_lanes = COALESCE(n_nearby_bus_lanes, :n_nearby_bus_lanes)
+                    WHERE listing_id = :listing_id
+                    and city = :city
+                    and business_type = :business_type
+                    """
+                ),
+                updates,
+            )
+        if attempted:
+            # Moves attempted listings behind the ones not attempted for longer
+            conn.execute(
+                text(
+                    """
+                    UPDATE fact_listings
+                    SET enrichment_attempted_at = now()
+                    FROM unnest(:listing_ids, :business_types) AS attempted (listing_id, business_type)
+                    WHERE fact_listings.listing_id = attempted.listing_id
+                    and fact_listings.business_type = attempted.business_type
+                    and city = :city
+                    """
+                ),
+                {
+                    "city": city,
+                    "listing_ids": [listing.listing_id for listing in attempted],
+                    "business_types": [listing.business_type for listing in attempted],
+                },
+            )
+    if new_image_tiles or new_traffic_tiles:
+        # Later searches must see the tiles just saved
+        data_cache.invalidate_prefix("analysis_data")
+    logger.info(f"Backfilled enrichment of {len(updates)} listings")
+    return len(updates)
@@ -0,0 +1,136 @@
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from sqlalchemy import text
+
+# Configure logging
+logging.basicConfig(
+    format="%(asctime)s %(name)-12s %(levelname)-8s %(message)s", level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+
+class NeighborhoodWatermarks:
+    """
+    Update date watermarks of each neighborhood of a market. On delta runs searches
+    are sorted by update date and stop paging at listings not updated since the
+    neighborhood's last fully scraped run, with a full sweep every few days to find
+    deleted listings. Watermarks are per neighborhood, so neighborhoods skipped by
+    the scheduler or cut short by a budget don't hold back the others
+    """
+
+    def __init__(
+        self,
+        db_manager,
+        delta_mode: Optional[bool] = None,
+        full_sweep_days: Optional[float] = None,
+        overlap: timedelta = timedelta(days=1),
+    ):
+        """
+        Args:
+            db_manager: Database manager
+            delta_mode (bool): Whether delta runs are allowed, by default ETL_DELTA_MODE
+            full_sweep_days (float): Days between full sweeps of a neighborhood,
+                by default ETL_FULL_SWEEP_DAYS or 28
+            overlap (timedelta): Margin subtracted from the watermark, covering
+                listings updated while the previous run was scraping
+        """
+        self.db_manager = db_manager
+        if delta_mode is None:
+            delta_mode = os.getenv("ETL_DELTA_MODE", "").lower() in ("1", "true", "yes")
+        self.delta_mode = delta_mode
+        if full_sweep_days is None:
+            full_sweep_days = float(os.getenv("ETL_FULL_SWEEP_DAYS", "28"))
+        self.full_sweep_days = full_sweep_days
+        self.overlap = overlap
+
+    def get(self, city: str, business_type: str, unit_type: str) -> dict:
+        """Get the watermark and last full sweep of the neighborhoods of a market, by neighborhood"""
+        with self.db_manager.get_connection() as conn:
+            rows = conn.execute(
+                text(
+                    """
+                    SELECT neighborhood, watermark, full_sweep_at
+                    FROM etl_neighborhood_watermarks
+                    WHERE city = :city AND business_type = :business_type AND unit_type = :unit_type
+                    """
+                ),
+                {"city": city, "business_type": business_type, "unit_type": unit_type},
+            ).mappings().all()
+        return {row["neighborhood"]: dict(row) for row in rows}
+
+    def get_delta_watermarks(
+        self, city: str, business_type: str, unit_type: str, neighborhoods: list
+    ) -> dict:
+        """
+        Get the update date a delta run of each neighborhood can stop at
+        Returns:
+            Dictionary of watermarks by neighborhood, None for neighborhoods that
+            must be fully swept
+        """
+        watermarks = {neighborhood: None for neighborhood in neighborhoods}
+        if not self.delta_mode:
+            return watermarks
+        rows = self.get(city, business_type, unit_type)
+        now = datetime.now(timezone.utc)
+        for neighborhood in neighborhoods:
+            row = rows.get(neighborhood)
+            # Never fully swept, or its last full sweep is due
+            if row is None or row["full_sweep_at"] is None:
+                continue
+            if now - row["full_sweep_at"] > timedelta(days=self.full_sweep_days):
+                continue
+            watermarks[neighborhood] = row["watermark"] - self.overlap
+        n_delta = sum(watermark is not None for watermark in watermarks.values())
+        logger.info(
+            f"Delta run of {n_delta} of {len(neighborhoods)} neighborhoods of "
+            f"{unit_type} {business_type} in {city}, sweeping the others"
+        )
+        return watermarks
+
+    def record(
+        self, city: str, business_type: str, unit_type: str, watermark: datetime, full_sweeps: dict
+    ):
+        """
+        Move the watermarks of the neighborhoods a run found every change of
+        Args:
+            watermark (datetime): Start of the run, listings updated before it were seen
+            full_sweeps (dict): Neighborhoods whose pages were all scraped, with whether
+                the run swept every listing of the neighborhood
+        """
+        if not full_sweeps:
+            return
+        with self.db_manager.get_transaction() as conn:
+            conn.execute(
+                text(
+                    """
+                    INSERT INTO etl_neighborhood_watermarks (
+                        city, business_type, unit_type, neighborhood, watermark, full_sweep_at
+                    )
+                    VALUES (
+                        :city, :business_type, :unit_type, :neighborhood, :watermark,
+                        CASE WHEN :full_sweep THEN CAST(:watermark AS timestamptz) END
+                    )
+                    ON CONFLICT (city, business_type, unit_type, neighborhood)
+                    DO UPDATE SET
+                        watermark = EXCLUDED.watermark,
+                        full_sweep_at = COALESCE(
+                            EXCLUDED.full_sweep_at, etl_neighborhood_watermarks.full_sweep_at
+                        ),
+                        updated_at = now()
+                    """
+                ),
+                [
+                    {
+                        "city": city,
+                        "business_type": business_type,
+                        "unit_type": unit_type,
+                        "neighborhood": neighborhood,
+                        "watermark": watermark,
+                        "full_sweep": full_sweep,
+                    }
+                    for neighborhood, full_sweep in full_sweeps.items()
+                ],
+            )
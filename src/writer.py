@@ -0,0 +1,100 @@
+import atexit
+import logging
+import queue
+import threading
+import time
+
+# Configure logging
+logging.basicConfig(
+    format="%(asctime)s %(name)-12s %(levelname)-8s %(message)s", level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+
+class WriterError(Exception):
+    """Raised on the caller's thread when a background write failed"""
+
+
+class BackgroundDatabaseWriter:
+    """
+    Runs database writes on a background thread with a bounded queue, so saving
+    a finished neighborhood overlaps with scraping the next one
+    """
+
+    _stop = object()
+
+    def __init__(self, max_pending: int = 8):
+        # Submitting blocks while the queue is full, so scraping can't outrun the DB
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._error = None
+        self._closed = False
+        self._thread = threading.Thread(
+            target=self._run, name="database-writer", daemon=True
+        )
+        self._thread.start()
+        # Pending writes are flushed even if the caller never closes the writer
+        atexit.register(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.close()
+        except WriterError:
+            # Don't mask the exception raised on the caller's thread
+            if exc_type is None:
+                raise
+
+    def submit(self, description: str, function, *args, **kwargs):
+        """
+        Queue a write to be run on the background thread
+        Args:
+            description (str): Description used on logs and errors
+            function: Callable performing the write
+        """
+        self.raise_if_failed()
+        if self._closed:
+            raise WriterError("Can't submit writes to a closed writer")
+        self._queue.put((description, function, args, kwargs))
+
+    def _run(self):
+        """Run queued writes in order until the writer is closed"""
+        while True:
+            item = self._queue.get()
+            try:
+                if item is self._stop:
+                    return
+                description, function, args, kwargs = item
+                # Once a write fails the following ones are skipped, as they may depend on it
+                if self._error is not None:
+                    logger.warning(f"Skipping {description} after a failed write")
+                    continue
+                start = time.perf_counter()
+                function(*args, **kwargs)
+                logger.info(f"Wrote {description} in {time.perf_counter() - start:.2f}s")
+            except Exception as error:
+                logger.error(f"Failed writing {description}: {error}")
+                self._error = (description, error)
+            finally:
+                self._queue.task_done()
+
+    def raise_if_failed(self):
+        """Raise the error of a failed background write on the caller's thread"""
+        if self._error is not None:
+            description, error = self._error
+            raise WriterError(f"Background write of {description} failed") from error
+
+    def flush(self):
+        """Wait until every queued write is done, raising if any of them failed"""
+        self._queue.join()
+        self.raise_if_failed()
+
+    def close(self):
+        """Flush pending writes and stop the background thread"""
+        if not self._closed:
+            self._closed = True
+            self._queue.put(self._stop)
+            self._thread.join()
+            atexit.unregister(self.close)
+        self.raise_if_failed()